@@ -0,0 +1,84 @@
+import time
+import asyncio
+import threading
+
+import numpy as np
+
+from BellmanBackup import _compiled, Qmax_vec, B_gs_vec, pi_greedy_vec
+
+# Anytime value iteration for asyncio code
+# The sweeps run in a worker thread (numpy releases the GIL in most of a sweep), a few at a time,
+#   ... and the values and greedy policy after each batch of sweeps are yielded to the event loop
+#
+#       async for V, residual, policy in solve_async(mdp, gamma, timeBudget=0.05):
+#           best = policy
+#
+# Stopping early (break, or cancelling the task) stops the worker after its current sweep
+
+
+
+# Value iteration as an async generator, yielding (V, residual, policy) after every 'sweepsPerYield' sweeps
+#   'V'         :  the state-values after the last sweep (a fresh array every time, so it's safe to keep)
+#   'residual'  :  max |V' - V| over the last sweep
+#   'policy'    :  the greedy policy as an int array (w.r.t. the values before the last sweep for mode 'vectorized',
+#                  ... so that V is its one-step lookahead, and w.r.t. V for mode 'gauss-seidel')
+# Stops after the sweep whose residual is less than 10**(-thresh), after 'maxIter' sweeps, or once 'timeBudget'
+#   ... seconds have passed since the call (at least one sweep is always done, so a budget overruns by upto a sweep)
+# 'mode' is 'vectorized' or 'gauss-seidel' (in blocks of 'blockSize' states), as in BellmanBackup.estimate_V_star
+# 'V' is an optional starting guess, e.g. the values of an earlier solve
+# 'executor' runs the sweeps (default: the event loop's default executor); it must be a thread pool
+async def solve_async(mdp, gamma, thresh=4, maxIter=10_000, timeBudget=None, sweepsPerYield=1, mode='vectorized',
+                          V=None, blockSize=256, executor=None):
+    if(mode not in ('vectorized', 'gauss-seidel')):
+        raise ValueError(f"Unknown value for arg 'mode': {mode} in call to solve_async()")
+    limit = (10**-thresh) if(thresh is not None) else 0.
+    deadline = None if (timeBudget is None) else time.perf_counter() + timeBudget
+    loop = asyncio.get_running_loop()
+    stop = threading.Event()
+
+    try:
+        c = await loop.run_in_executor(executor, _compiled, mdp)
+        V = np.zeros(c.nStates) if (V is None) else np.array(V, dtype=np.float64)
+        iterCnt = 0
+        while(iterCnt < maxIter):
+            k = min(sweepsPerYield, maxIter - iterCnt)
+            V, diff, pi, done = await loop.run_in_executor(executor, _sweeps, c, V, gamma, k, mode, blockSize,
+                                                               limit, deadline, stop)
+            iterCnt += done
+            yield V, diff, pi
+            if(diff < limit or (deadline is not None and time.perf_counter() >= deadline)):
+                break
+    finally:
+        stop.set()
+
+
+# Run solve_async() to the end, and return its last (V, residual, policy)
+# e.g. the best policy within 50 ms:    V, residual, policy = await solve_within(mdp, gamma, 0.05)
+async def solve_within(mdp, gamma, timeBudget, **kwargs):
+    last = None
+    async for last in solve_async(mdp, gamma, timeBudget=timeBudget, **kwargs):
+        pass
+    return last
+
+
+# Upto 'k' sweeps on a copy of 'V', in the worker thread
+# Stops early once a sweep's residual is less than 'limit', past the deadline, or when 'stop' is set
+# Returns (V, residual, policy, sweeps done)
+def _sweeps(c, V, gamma, k, mode, blockSize, limit, deadline, stop):
+    if(mode == 'gauss-seidel'):
+        V = V.copy()
+    done = 0
+    while(done < k):
+        if(mode == 'vectorized'):
+            VV, pi = Qmax_vec(c, V, gamma)
+            diff = np.abs(VV - V).max(initial=0.)
+            V = VV
+        else:
+            diff = B_gs_vec(c, V, gamma, blockSize=blockSize)
+        done += 1
+        if(diff < limit or stop.is_set() or (deadline is not None and time.perf_counter() >= deadline)):
+            break
+
+    if(mode == 'gauss-seidel'):
+        pi = pi_greedy_vec(c, V, gamma)
+    return V, diff, pi, done
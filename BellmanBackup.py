@@ -1,6 +1,13 @@
 
+import os
+import sys
+import time
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+
 import numpy as np
-from MDP import MDP
+from MDP import MDP, CompiledMDP, policy_key, values_key
+from SparseUtils import csr_row_ids, csr_gather, csr_matvec, gmres
 
 
 ############################
@@ -40,11 +47,16 @@ def Q_allActions(mdp: MDP, V: list[float], s: int, gamma: float) -> dict[int, fl
     
 # The one-step backup at each state-action pair of the given MDP, based on state-values 'V'
 # Returns a list 'Q' such that, for each state 's' Q[s] is a dict {a: Q^V(s,a)}
+# The tables are kept in mdp.policyCache (keyed by V and gamma), and every call returns a fresh copy
 def Q_allStates(mdp: MDP, V: list[float], gamma: float) -> list[dict[int,float]]:
-    ret = []
-    for s in range(mdp.nStates):
-        ret.append({ a : Q(mdp=mdp, V=V, s=s, a=a, gamma=gamma)   for a in mdp.possibleActions(s)})
-    return ret
+    key = ('Q', values_key(V), gamma)
+    ret = mdp.policyCache.get(key)
+    if(ret is None):
+        ret = []
+        for s in range(mdp.nStates):
+            ret.append({ a : Q(mdp=mdp, V=V, s=s, a=a, gamma=gamma)   for a in mdp.possibleActions(s)})
+        mdp.policyCache.put(key, ret, sys.getsizeof(ret) + sum(sys.getsizeof(q) + 24*len(q) for q in ret))
+    return [q.copy() for q in ret]
     
 
 # Get the max one-step backup (over all actions) of the vector 'V' at state s
@@ -98,27 +110,374 @@ def pi_greedy(mdp, V, gamma):
 
 
 
+#################################
+#  VECTORIZED BACKUP OPERATORS
+#################################
+# These work on the compiled (array-backed) model of the MDP, see MDP.compile()
+# They take either an MDP or a CompiledMDP, state-values 'V' as an nStates-vector,
+#   ... and policies as an int array of one action per state (a dict s -> a is also accepted)
+# Q-values come as an (nStates, nActions) array, with -inf at the state-action pairs that aren't possible
+
+
+# Get the compiled model of 'mdp', passing a CompiledMDP through as-is
+def _compiled(mdp) -> CompiledMDP:
+    return mdp.compile() if isinstance(mdp, MDP) else mdp
+
+
+# Convert a policy dict {s: a} to an int array 'pi' such that pi[s] = a
+def policy_to_array(policy, nStates: int) -> np.ndarray:
+    if(isinstance(policy, np.ndarray)):
+        return policy.astype(np.int64, copy=False)
+    missing_states = [st for st in range(nStates) if st not in policy.keys()]
+    if(len(missing_states)):
+        raise ValueError(f"The given policy has some missing states: {missing_states}")
+    return np.array([policy[s] for s in range(nStates)], dtype=np.int64)
+
+
+# Convert a policy array 'pi' to a dict {s: pi[s]}
+def policy_to_dict(policy: np.ndarray) -> dict[int,int]:
+    return dict(enumerate(np.asarray(policy).tolist()))
+
+
+# Convert the given policy to an array, and check that it only takes possible actions
+def _policy_array(cmdp: CompiledMDP, policy) -> np.ndarray:
+    pi = policy_to_array(policy, cmdp.nStates)
+    if(len(pi) != cmdp.nStates):
+        raise ValueError(f"Expected a policy over {cmdp.nStates} states, got one over {len(pi)} states")
+    if(pi.min(initial=0) < 0 or pi.max(initial=0) >= cmdp.nActions or not cmdp.valid[np.arange(cmdp.nStates), pi].all()):
+        bad = [s for s in range(cmdp.nStates) if not (0 <= pi[s] < cmdp.nActions and cmdp.valid[s, pi[s]])]
+        raise ValueError(f"The given policy maps some states to invalid actions: {bad}")
+    return pi
+
+
+# The one-step backup Q^V(s,a) of every state-action pair, as an (nStates, nActions) array
+def Q_vec(mdp, V, gamma: float) -> np.ndarray:
+    c = _compiled(mdp)
+    V = np.asarray(V, dtype=np.float64)
+    EV = np.bincount(c.rows(), weights=c.probs*V[c.next_states], minlength=c.nStates*c.nActions)
+    Q = c.expected_rewards() + gamma*EV.reshape(c.nStates, c.nActions)
+    Q[~c.valid] = -np.inf
+    return Q
+
+
+# The max one-step backup of 'V' at every state
+# Returns the arrays (bigQ, bigA) of the max value over all possible actions, and the action where it occurs
+def Qmax_vec(mdp, V, gamma: float) -> tuple[np.ndarray, np.ndarray]:
+    Q = Q_vec(mdp, V, gamma)
+    bigA = Q.argmax(axis=1)
+    return Q[np.arange(len(bigA)), bigA], bigA
+
+
+# B_pi over all states at once, see Bpi()
+def Bpi_vec(mdp, V, policy, gamma: float) -> np.ndarray:
+    return Bpi_k_vec(mdp, 1, V, policy, gamma)
+
+
+# [B_pi ** k][V], building the policy's transition matrix only once
+def Bpi_k_vec(mdp, k: int, V, policy, gamma: float) -> np.ndarray:
+    c = _compiled(mdp)
+    pi = _policy_array(c, policy)
+    indptr, indices, data = c.policy_matrix(pi)
+    rows = csr_row_ids(indptr)
+    R = c.policy_rewards(pi)
+    V = np.asarray(V, dtype=np.float64)
+    for i in range(k):
+        V = R + gamma*csr_matvec(indptr, indices, data, V, rows=rows)
+    return V
+
+
+# The bellman optimality operator over all states at once, see B()
+def B_vec(mdp, V, gamma: float) -> np.ndarray:
+    return Q_vec(mdp, V, gamma).max(axis=1)
+
+
+# [B ** k][V], see B_k()
+def B_k_vec(mdp, k: int, V, gamma: float) -> np.ndarray:
+    c = _compiled(mdp)
+    V = np.asarray(V, dtype=np.float64)
+    for i in range(k):
+        V = B_vec(c, V, gamma)
+    return V
+
+
+# The one-step backups Q^V(s,a) of the given states only (an int array), as a (len(states), nActions) array
+def Q_states_vec(mdp, V, states, gamma: float) -> np.ndarray:
+    c = _compiled(mdp)
+    k = (states[:,None]*c.nActions + np.arange(c.nActions)).ravel()
+    ptr, idx = csr_gather(c.indptr, k)
+    EV = np.bincount(csr_row_ids(ptr), weights=c.probs[idx]*V[c.next_states[idx]], minlength=len(k))
+    Q = c.expected_rewards()[states] + gamma*EV.reshape(len(states), c.nActions)
+    Q[~c.valid[states]] = -np.inf
+    return Q
+
+
+# The backups max_a Q^V(s,a) of a block of consecutive states, from the arrays of just the block's transitions:
+#   ... 'rows' holds the state-action pair of each transition, counted from the block's first pair (in any order),
+#   ... and 'R', 'valid' are the block's expected rewards and possible actions, of shape (states in block, nActions)
+# B_gs_vec, the 'parallel' mode and OutOfCore.estimate_V_star_ooc all back up blocks with this
+def B_block_vec(rows, probs, next_states, R, valid, V, gamma: float) -> np.ndarray:
+    n, nActions = valid.shape
+    EV = np.bincount(rows, weights=probs*V[next_states], minlength=n*nActions)
+    Q = R + gamma*EV.reshape(n, nActions)
+    Q[~valid] = -np.inf
+    return Q.max(axis=1)
+
+
+# One in-place Gauss-Seidel sweep of the bellman optimality operator over 'V' (a float array, which gets modified)
+# The states are backed up in order, in blocks of 'blockSize', each block using the values updated by the blocks before it
+#   ... blockSize=1 is the classic state-by-state sweep, while larger blocks spend less time in the interpreter
+# Returns the max change in V over the sweep
+def B_gs_vec(mdp, V: np.ndarray, gamma: float, blockSize=256) -> float:
+    c = _compiled(mdp)
+    rows = c.rows()
+    R = c.expected_rewards()
+    diff = 0.
+    for lo in range(0, c.nStates, blockSize):
+        hi = min(lo + blockSize, c.nStates)
+        k0, k1 = c.indptr[lo*c.nActions], c.indptr[hi*c.nActions]
+        newV = B_block_vec(rows[k0:k1] - lo*c.nActions, c.probs[k0:k1], c.next_states[k0:k1], R[lo:hi], c.valid[lo:hi],
+                               V, gamma)
+        diff = max(diff, np.abs(newV - V[lo:hi]).max(initial=0.))
+        V[lo:hi] = newV
+    return diff
+
+
+# The greedy policy for 'V', as an int array of one action per state, see pi_greedy()
+# Ties go to the lowest-numbered action, same as pi_greedy()
+def pi_greedy_vec(mdp, V, gamma: float) -> np.ndarray:
+    return Q_vec(mdp, V, gamma).argmax(axis=1)
+
+
+
+
+##########################
+#  SOLVER INSTRUMENTATION
+##########################
+# The solvers take an optional 'callback', which they call once per sweep as
+#       callback(iterCnt, residual, elapsed, nBackups, policyChanges)
+#   'iterCnt'        :  the sweeps done so far, in the units of the iterCnt that the solver returns
+#   'residual'       :  the quantity that the solver compares against 10**(-thresh), e.g. max |V' - V| over the sweep
+#   'elapsed'        :  seconds since the solve started
+#   'nBackups'       :  the state backups (or matrix-vector products, times nStates) done so far
+#   'policyChanges'  :  how many states changed their greedy action in this sweep, or None where the solver doesn't track it
+# If the callback returns True, the solver stops and returns what it has so far
+# Without a callback, the solvers don't time sweeps or compute policies, so that costs nothing
+
+
+# Calls the user's callback, keeping the start time and the last policy seen
+class _Reporter:
+    def __init__(self, callback, pi=None):
+        self.callback = callback
+        self.t0 = time.perf_counter()
+        self.pi = pi
+    
+    def __call__(self, iterCnt, residual, nBackups, pi=None) -> bool:
+        changes = None
+        if(pi is not None):
+            changes = len(pi) if (self.pi is None) else int(np.count_nonzero(pi != self.pi))
+            self.pi = pi
+        return bool(self.callback(int(iterCnt), float(residual), time.perf_counter() - self.t0, int(nBackups), changes))
+
+
+def _reporter(callback, pi=None):
+    return None if (callback is None) else _Reporter(callback, pi)
+
+
+# A callback that records the convergence trace of a solve, one entry per call:
+#       trace = ConvergenceTrace()
+#       V, iterCnt = estimate_V_star(mdp, gamma, callback=trace)
+#       trace.residual[-10:], trace.stalled()
+# 'every' records only every so many calls (the first one is always recorded), for long solves
+# 'stallWindow', if given, stops the solve once it has stalled (see stalled()) over that many recorded entries
+class ConvergenceTrace:
+    def __init__(self, every=1, stallWindow=None, stallRatio=0.99):
+        self.every = every
+        self.stallWindow = stallWindow
+        self.stallRatio = stallRatio
+        self.nCalls = 0
+        self.iterCnt, self.residual, self.elapsed, self.nBackups, self.policyChanges = [], [], [], [], []
+    
+    def __call__(self, iterCnt, residual, elapsed, nBackups, policyChanges=None) -> bool:
+        self.nCalls += 1
+        if((self.nCalls - 1) % self.every):
+            return False
+        self.iterCnt.append(iterCnt)
+        self.residual.append(residual)
+        self.elapsed.append(elapsed)
+        self.nBackups.append(nBackups)
+        self.policyChanges.append(policyChanges)
+        return (self.stallWindow is not None) and self.stalled(self.stallWindow, self.stallRatio)
+    
+    def __len__(self):
+        return len(self.iterCnt)
+    
+    # derived attributes:
+    #   'sweep_times'  :  the seconds between adjacent entries (the first one since the start)
+    #   'rate'         :  the average factor by which the residual shrank per sweep, over the whole trace
+    def __getattr__(self, name):
+        if(name == 'sweep_times'):
+            return np.diff(self.elapsed, prepend=0.)
+        elif(name == 'rate'):
+            if(len(self) < 2 or self.residual[0] <= 0 or self.iterCnt[-1] == self.iterCnt[0]):
+                return float('nan')
+            return (self.residual[-1] / self.residual[0]) ** (1 / (self.iterCnt[-1] - self.iterCnt[0]))
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+    
+    # True if the residual shrank by less than a factor 'ratio' over the last 'window' entries
+    def stalled(self, window=100, ratio=0.99) -> bool:
+        if(len(self) <= window):
+            return False
+        return self.residual[-1] > ratio * self.residual[-1-window]
+    
+    def to_dict(self) -> dict:
+        return {'iterCnt'        :  list(self.iterCnt),
+                'residual'       :  list(self.residual),
+                'elapsed'        :  list(self.elapsed),
+                'nBackups'       :  list(self.nBackups),
+                'policyChanges'  :  list(self.policyChanges)}
+
+
+
 #################
 #  ALGORITHMS
 #################
 
 
-# estimate the state-values of the given mdp for the given policy, under d.f.=gamma,
-#   ... by repeatedly applying the 'B_pi' operator on a random vector
-# computes B_pi[V] iteratively, upto  'maxIter' times
-# stops when adjacent computations differ by less than 10**(-thresh), in all the elements
+# estimate the state-values of the given mdp for the given policy, under d.f.=gamma
+# V_pi is the solution of the linear system (I - gamma*P_pi) V = R_pi, which 'method' solves as:
+#       'direct'    :  a dense LU solve on the policy's transition matrix (see CompiledMDP.policy_matrix), for small models
+#       'gmres'     :  restarted GMRES on the sparse P_pi of the compiled model, for large models
+#       'auto'      :  'direct' upto DIRECT_SOLVE_MAX_STATES states, else 'gmres', falling back to 'iterate'
+#                      ... for gamma >= 1 and for systems that are (close to) singular
+#       'iterate'   :  repeated vectorized B_pi sweeps, stopping when adjacent sweeps differ by less than 10**(-thresh)
+#       'python'    :  repeated B_pi on the dict-based model, checking the threshold every 100 sweeps
+# 'direct' and 'gmres' need gamma < 1, since I - P_pi is singular (a ValueError is raised otherwise)
+#   ... and 'direct' also raises a ValueError for a system too close to singular (e.g. probs that add up to more than 1)
+# For 'gmres', the residual is driven low enough that V is within 10**(-thresh) of V_pi in every element
 # set thresh=None to not consider a threshold, running till 'maxIter' is exhausted
-def estimate_V_pi(mdp, policy, gamma, thresh=4, maxIter=10_000):
+# 'V' is an optional starting guess (used by the iterative methods)
+# 'callback' is called after every sweep, see SOLVER INSTRUMENTATION (for 'gmres', after every matrix-vector product
+#   ... with the 2-norm of the linear residual, and for 'direct', once with the max-norm of the linear residual)
+# Returns (V, iterCnt), with iterCnt counting sweeps / matrix-vector products (and 1 for 'direct')
+# Solves without a starting guess or a callback are kept in mdp.policyCache, keyed by the policy and the settings
+#   ... and repeating one returns a copy of the cached V, with the iterCnt of the original solve
+def estimate_V_pi(mdp, policy, gamma, thresh=4, maxIter=10_000, method='auto', V=None, callback=None):
+    pKey = policy_key(policy, mdp.nStates) if (isinstance(mdp, MDP) and V is None and callback is None) else None
+    if(pKey is None):
+        return _estimate_V_pi(mdp, policy, gamma, thresh, maxIter, method, V, callback)
+    key = ('V_pi', pKey, gamma, thresh, maxIter, method)
+    hit = mdp.policyCache.get(key)
+    if(hit is None):
+        hit = _estimate_V_pi(mdp, policy, gamma, thresh, maxIter, method, V, callback)
+        mdp.policyCache.put(key, hit, 8*mdp.nStates)
+    V, iterCnt = hit
+    return V.copy(), iterCnt
+
+
+def _estimate_V_pi(mdp, policy, gamma, thresh, maxIter, method, V, callback):
     limit = (10**-thresh) if(thresh is not None) else 0.
-    V = [0.] * mdp.nStates
+    report = _reporter(callback)
+    if(method == 'auto'):
+        if(gamma >= 1):
+            method = 'iterate'
+        elif(mdp.nStates <= DIRECT_SOLVE_MAX_STATES):
+            try:
+                return _estimate_V_pi_direct(mdp, policy, gamma, report)
+            except np.linalg.LinAlgError:
+                method = 'iterate'
+        else:
+            method = 'gmres'
+        
+    if(method == 'direct'):
+        if(gamma >= 1):
+            raise ValueError(f"Method 'direct' needs gamma < 1, got gamma={gamma} in call to estimate_V_pi()")
+        try:
+            return _estimate_V_pi_direct(mdp, policy, gamma, report)
+        except np.linalg.LinAlgError as e:
+            raise ValueError(f"Can't solve for V_pi with method 'direct': {e}") from e
+    elif(method == 'gmres'):
+        if(gamma >= 1):
+            raise ValueError(f"Method 'gmres' needs gamma < 1, got gamma={gamma} in call to estimate_V_pi()")
+        return _estimate_V_pi_gmres(mdp, policy, gamma, limit, maxIter, V, report)
+    elif(method == 'iterate'):
+        return _estimate_V_pi_iterate(mdp, policy, gamma, limit, maxIter, V, report)
+    elif(method == 'python'):
+        return _estimate_V_pi_python(mdp, policy, gamma, limit, maxIter, V, report)
+    else:
+        raise ValueError(f"Unknown value for arg 'method': {method} in call to estimate_V_pi()")
+
+# The largest model for which estimate_V_pi(method='auto') does a dense solve
+# The dense LU costs O(nStates**3) and two nStates x nStates matrices, and on Garnet MDPs it's slower than 'gmres'
+#   ... from about 250 states on (about 9x slower at 1000 states); below that 'gmres' is dominated by its overheads
+DIRECT_SOLVE_MAX_STATES = 200
+
+
+# The largest condition number of (I - gamma*P_pi) for which a dense solve is trusted
+DIRECT_SOLVE_MAX_COND = 1e10
+
+
+# Raises np.linalg.LinAlgError if (I - gamma*P_pi) is singular or too close to it
+# With P_pi >= 0 and gamma*P_pi of spectral radius < 1, the inverse of A = I - gamma*P_pi is non-negative,
+#   ... so W = A^-1 @ 1 (solved along with V) gives ||A^-1||_inf = max(W); a negative W means that's not the case
+def _estimate_V_pi_direct(mdp, policy, gamma, report=None):
+    c = _compiled(mdp)
+    pi = _policy_array(c, policy)
+    indptr, nextStates, probs = c.policy_matrix(pi)
+    P = np.zeros((c.nStates, c.nStates))
+    np.add.at(P, (csr_row_ids(indptr), nextStates), probs)
+    A = np.eye(c.nStates) - gamma*P
+    R = c.policy_rewards(pi)
+    VW = np.linalg.solve(A, np.stack((R, np.ones(c.nStates)), axis=1))
+    V, W = VW[:,0], VW[:,1]
+    cond = np.abs(A).sum(axis=1).max(initial=0.) * W.max(initial=0.)
+    if(not np.isfinite(VW).all() or W.min(initial=0.) < 0 or cond > DIRECT_SOLVE_MAX_COND):
+        raise np.linalg.LinAlgError(f"I - gamma*P_pi is singular or too close to it (condition number ~{cond:.3g})")
+    if(report):
+        report(1, np.abs(A @ V - R).max(initial=0.), c.nStates)
+    return V, 1
+
+
+def _estimate_V_pi_gmres(mdp, policy, gamma, limit, maxIter, V, report=None):
+    c = _compiled(mdp)
+    pi = _policy_array(c, policy)
+    indptr, indices, data = c.policy_matrix(pi)
+    rows = csr_row_ids(indptr)
+    matvec = lambda x: x - gamma*csr_matvec(indptr, indices, data, x, rows=rows)
+    # ||V - V_pi||_inf <= ||residual||_inf / (1-gamma) <= ||residual||_2 / (1-gamma)
+    atol = limit * (1 - gamma) if (gamma < 1) else limit
+    callback = None if (report is None) else (lambda nIter, res: report(nIter, res, nIter*c.nStates))
+    return gmres(matvec, c.policy_rewards(pi), x0=V, atol=atol, maxIter=maxIter, callback=callback)
+
+
+def _estimate_V_pi_iterate(mdp, policy, gamma, limit, maxIter, V, report=None):
+    c = _compiled(mdp)
+    pi = _policy_array(c, policy)
+    indptr, indices, data = c.policy_matrix(pi)
+    rows = csr_row_ids(indptr)
+    R = c.policy_rewards(pi)
+    V = np.zeros(c.nStates) if (V is None) else np.asarray(V, dtype=np.float64)
     iterCnt = 0
     while(iterCnt < maxIter):
-        Bpi_k(mdp=mdp, k=99, V=V, policy=policy, gamma=gamma)
+        VV = R + gamma*csr_matvec(indptr, indices, data, V, rows=rows)
+        iterCnt += 1
+        diff = np.abs(VV - V).max(initial=0.)
+        V = VV
+        if((report and report(iterCnt, diff, iterCnt*c.nStates)) or diff < limit):
+            break
+    
+    return V, iterCnt
+
+
+def _estimate_V_pi_python(mdp, policy, gamma, limit, maxIter, V, report=None):
+    V = [0.] * mdp.nStates if (V is None) else list(V)
+    iterCnt = 0
+    while(iterCnt < maxIter):
+        V = Bpi_k(mdp=mdp, k=99, V=V, policy=policy, gamma=gamma)
         VV = Bpi(mdp=mdp, V=V, policy=policy, gamma=gamma)
         # compute the max element of |VV - V|,   a.k.a ||VV - V||_inf
         diff = l_inf(vec_diff(VV,V))
-        if(diff < limit):
-            return VV, iterCnt
+        if((report and report(iterCnt+100, diff, (iterCnt+100)*mdp.nStates)) or diff < limit):
+            return VV, iterCnt+100
         V = VV
         iterCnt += 100
     
@@ -130,24 +489,523 @@ def estimate_V_pi(mdp, policy, gamma, thresh=4, maxIter=10_000):
 # computes B[V] iteratively, upto  'maxIter' times
 # stops when adjacent computations differ by less than 10**(-thresh), in all the elements
 # set thresh=None to not consider a threshold, running till 'maxIter' is exhausted
-def estimate_V_star(mdp, gamma, thresh=4, maxIter=10_000):
+# 'mode' picks how the sweeps are done:
+#       'vectorized'    :  B_vec on the compiled model, checking the threshold after every sweep (returns V as an array)
+#       'python'        :  B on the dict-based model, checking the threshold every 100 sweeps (returns V as a list)
+#       'parallel'      :  like 'vectorized', with each sweep split into blocks of states over 'nWorkers' processes
+#                          ... (default: all CPUs) that share the compiled model and V through shared memory
+#       'gauss-seidel'  :  in-place sweeps (see B_gs_vec) in blocks of 'blockSize' states, stopping when a sweep
+#                          ... changes no element by 10**(-thresh) or more
+#       'prioritized'   :  prioritized sweeping: repeatedly backs up the 'blockSize' states with the largest Bellman residual
+#                          ... (or more, while many states are queued, see PRIORITIZED_POOL_SHARE), then updates the residuals of just their predecessors (see CompiledMDP.predecessors),
+#                          ... till every residual is less than 10**(-thresh)
+#                          ... iterCnt and maxIter count sweep-equivalents, i.e. state backups / nStates (rounded up)
+#       'topological'   :  solves the strongly connected components of the state graph (see CompiledMDP.components)
+#                          ... downstream ones first, sweeping only the components whose values can still change
+#                          ... Consecutive levels of components are swept together in blocks of about 'blockSize' states,
+#                          ... and a level leaves its block once it, and every level below it, changes by less than 10**(-thresh)
+#                          ... iterCnt counts sweep-equivalents as in 'prioritized', while maxIter bounds the sweeps per block
+#       'elimination'   :  vectorized sweeps with action elimination, stopping on an error bound rather than on the
+#                          ... difference of adjacent sweeps, see value_iteration_elimination()
+# 'callback' is called after every sweep, see SOLVER INSTRUMENTATION
+#   ... 'vectorized' and 'elimination' report the greedy policy changes, 'prioritized' reports once per sweep-equivalent,
+#   ... 'topological' after every sweep of a block, and 'python' every 100 sweeps
+# 'V' is an optional starting guess (default: zeros), e.g. the values of an earlier solve of a similar model
+def estimate_V_star(mdp, gamma, thresh=4, maxIter=10_000, mode='vectorized', nWorkers=None, blockSize=256, V=None,
+                        callback=None):
     limit = (10**-thresh) if(thresh is not None) else 0.
-    V = [0.] * mdp.nStates
+    report = _reporter(callback)
+    if(mode == 'vectorized'):
+        return _estimate_V_star_vectorized(mdp, gamma, limit, maxIter, V, report)
+    elif(mode == 'gauss-seidel'):
+        return _estimate_V_star_gauss_seidel(mdp, gamma, limit, maxIter, blockSize, V, report)
+    elif(mode == 'prioritized'):
+        return _estimate_V_star_prioritized(mdp, gamma, limit, maxIter, blockSize, V, report)
+    elif(mode == 'topological'):
+        return _estimate_V_star_topological(mdp, gamma, limit, maxIter, blockSize, V, report)
+    elif(mode == 'parallel'):
+        return _estimate_V_star_parallel(mdp, gamma, limit, maxIter, nWorkers, V, report)
+    elif(mode == 'elimination'):
+        V, iterCnt, errBound, active = value_iteration_elimination(mdp, gamma, thresh=thresh, maxIter=maxIter, V=V,
+                                                                   callback=callback)
+        return V, iterCnt
+    elif(mode == 'python'):
+        return _estimate_V_star_python(mdp, gamma, limit, maxIter, V, report)
+    else:
+        raise ValueError(f"Unknown value for arg 'mode': {mode} in call to estimate_V_star()")
+
+
+def _estimate_V_star_python(mdp, gamma, limit, maxIter, V=None, report=None):
+    V = [0.] * mdp.nStates if (V is None) else list(V)
     iterCnt = 0
     while(iterCnt < maxIter):
-        B_k(mdp=mdp, k=99, V=V, gamma=gamma)
+        V = B_k(mdp=mdp, k=99, V=V, gamma=gamma)
         VV = B(mdp=mdp, V=V, gamma=gamma)
         # compute the max element of |VV - V|,   a.k.a ||VV - V||_inf
         diff = l_inf(vec_diff(VV,V))
-        if(diff < limit):
-            return VV, iterCnt
+        if((report and report(iterCnt+100, diff, (iterCnt+100)*mdp.nStates)) or diff < limit):
+            return VV, iterCnt+100
         V = VV
         iterCnt += 100
     
     return V, iterCnt
 
 
+def _estimate_V_star_vectorized(mdp, gamma, limit, maxIter, V=None, report=None):
+    c = _compiled(mdp)
+    V = np.zeros(c.nStates) if (V is None) else np.asarray(V, dtype=np.float64)
+    iterCnt = 0
+    while(iterCnt < maxIter):
+        if(report):
+            VV, greedy = Qmax_vec(c, V, gamma)
+        else:
+            VV = B_vec(c, V, gamma)
+        iterCnt += 1
+        diff = np.abs(VV - V).max(initial=0.)
+        V = VV
+        if((report and report(iterCnt, diff, iterCnt*c.nStates, greedy)) or diff < limit):
+            break
+    
+    return V, iterCnt
+
+
+def _estimate_V_star_gauss_seidel(mdp, gamma, limit, maxIter, blockSize, V=None, report=None):
+    c = _compiled(mdp)
+    V = np.zeros(c.nStates) if (V is None) else np.array(V, dtype=np.float64)
+    iterCnt = 0
+    while(iterCnt < maxIter):
+        diff = B_gs_vec(c, V, gamma, blockSize=blockSize)
+        iterCnt += 1
+        if((report and report(iterCnt, diff, iterCnt*c.nStates)) or diff < limit):
+            break
+    
+    return V, iterCnt
+
+
+def _estimate_V_star_prioritized(mdp, gamma, limit, maxIter, blockSize, V=None, report=None):
+    c = _compiled(mdp)
+    V = np.zeros(c.nStates) if (V is None) else np.array(V, dtype=np.float64)
+    residual = np.abs(B_vec(c, V, gamma) - V)
+    nBackups = _prioritized_sweeps(c, V, residual, gamma, limit, maxIter*c.nStates, blockSize, report)
+    return V, -(-nBackups // c.nStates)
+
 
+# Each batch of mode 'prioritized' backs up at least 1/PRIORITIZED_POOL_SHARE of the states queued for a backup
+PRIORITIZED_POOL_SHARE = 8
 
+# Once the predecessors of a batch are 1/PRIORITIZED_FULL_SHARE of the states or more, mode 'prioritized'
+#   ... recomputes every residual in one vectorized pass (see Q_vec), and backs up the whole queue in the next batch
+PRIORITIZED_FULL_SHARE = 4
 
 
+# The sweeps of mode 'prioritized', backing up 'V' in place till every state's residual is less than 'limit'
+# 'residual' holds the current Bellman residual of each state (and gets modified)
+# If 'pi' (an int array) is given, the states backed up also get their greedy actions updated in it, see _improve_policy()
+# Returns the no. of state backups done, which stops after about 'maxBackups'
+# On models where every state has many predecessors (e.g. Garnet MDPs), this turns into vectorized sweeps over the
+#   ... states that are still queued, so it costs about as much as mode 'vectorized' rather than many times more
+def _prioritized_sweeps(c, V, residual, gamma, limit, maxBackups, blockSize, report=None, pi=None) -> int:
+    predPtr, preds = c.predecessors()
+    # the states queued for a backup, i.e. those whose residual was last seen to be 'limit' or more, each at most once
+    queued = residual >= limit
+    pool = np.flatnonzero(queued)
+    slot = np.empty(c.nStates, dtype=np.int64)     # scratch space, to drop duplicate states without sorting them
+    Qall, BVall = None, None        # the Q-values and backups of every state, while they're up to date with V
+    
+    nBackups = 0
+    while(nBackups < maxBackups):
+        res = residual[pool]
+        live = res >= limit
+        if(not live.all()):
+            queued[pool[~live]] = False
+            pool, res = pool[live], res[live]
+        if(not len(pool)):
+            break
+        if(Qall is not None):
+            states = pool
+            V[states] = BVall[states]
+            if(pi is not None):
+                pi[states] = _improve_policy(Qall[states], pi[states])
+        else:
+            # a batch is at least a fixed share of the pool, so that picking it costs O(1) per backup, amortized
+            size = max(blockSize, len(pool) // PRIORITIZED_POOL_SHARE)
+            states = pool if (len(pool) <= size) else pool[np.argpartition(res, -size)[-size:]]
+            Q = Q_states_vec(c, V, states, gamma)
+            V[states] = Q.max(axis=1)
+            if(pi is not None):
+                pi[states] = _improve_policy(Q, pi[states])
+        nBackups += len(states)
+        
+        # only the states whose backups read the changed values need their residuals updated
+        affected = states
+        if(len(states) * PRIORITIZED_FULL_SHARE < c.nStates):
+            ptr, idx = csr_gather(predPtr, states)
+            affected = np.concatenate((preds[idx], states))
+            slot[affected] = np.arange(len(affected))
+            affected = affected[slot[affected] == np.arange(len(affected))]
+        if(len(affected) * PRIORITIZED_FULL_SHARE >= c.nStates):
+            Qall = Q_vec(c, V, gamma)
+            BVall = Qall.max(axis=1)
+            affected = np.arange(c.nStates)
+            newRes = np.abs(BVall - V)
+        else:
+            Qall = None
+            newRes = np.abs(Q_states_vec(c, V, affected, gamma).max(axis=1) - V[affected])
+        residual[affected] = newRes
+        new = affected[(newRes >= limit) & ~queued[affected]]
+        queued[new] = True
+        pool = np.concatenate((pool, new))
+        
+        if(report and (nBackups - len(states)) // c.nStates < nBackups // c.nStates):
+            if(report(nBackups // c.nStates, residual.max(initial=0.), nBackups)):
+                break
+    
+    return nBackups
+
+
+def _estimate_V_star_topological(mdp, gamma, limit, maxIter, blockSize, V=None, report=None):
+    c = _compiled(mdp)
+    nComps, labels, levels, cyclic = c.components()
+    order = np.lexsort((labels, levels[labels]))            # the states, by level and then by component
+    stLevel = levels[labels][order]
+    stCyclic = cyclic[labels][order]
+    
+    # group consecutive levels into blocks of at least 'blockSize' states
+    levelStarts = np.flatnonzero(np.diff(stLevel, prepend=-1)).tolist() + [c.nStates]
+    blocks = []
+    lo = 0
+    for hi in levelStarts[1:]:
+        if(hi - lo >= blockSize or hi == c.nStates):
+            blocks.append((lo, hi))
+            lo = hi
+    
+    V = np.zeros(c.nStates) if (V is None) else np.array(V, dtype=np.float64)
+    nBackups = 0
+    for lo, hi in blocks:
+        states, lvls, cyc = order[lo:hi], stLevel[lo:hi], stCyclic[lo:hi]
+        sweeps = 0
+        while(len(states) and sweeps < maxIter):
+            newV = Q_states_vec(c, V, states, gamma).max(axis=1)
+            change = np.abs(newV - V[states])
+            changing = change >= limit
+            V[states] = newV
+            sweeps += 1
+            nBackups += len(states)
+            if(report and report(-(-nBackups // c.nStates), change.max(initial=0.), nBackups)):
+                return V, -(-nBackups // c.nStates)
+            # the lowest level only reads final values, so its acyclic states are now exact
+            changing &= cyc | (lvls != lvls[0])
+            if(not changing.any()):
+                break
+            # drop the levels below the lowest one that's still changing, since nothing below them changes any more
+            keep = lvls >= lvls[np.argmax(changing)]
+            states, lvls, cyc = states[keep], lvls[keep], cyc[keep]
+    
+    return V, -(-nBackups // c.nStates)
+
+
+# Re-solve V_star incrementally, after the transitions of a few state-action pairs of a solved model were changed
+# 'V' are the state-values of the earlier solve (e.g. from estimate_V_star), and 'policy' their greedy policy, if known
+# 'changed' are the (st,a) pairs changed since, by default mdp.changedPairs (which then gets emptied), see MDP.setTransition()
+# The states of the changed pairs are backed up first, and then prioritized sweeping (as in estimate_V_star's mode
+#   ... 'prioritized') carries the updates back through the predecessors of the states whose values change,
+#   ... till every residual is less than 10**(-thresh)
+# That holds for the states that weren't reached too, as long as the earlier solve was done to the same threshold
+# If the changes spread to so much of the model that 'localBudget' sweep-equivalents of such backups don't settle them,
+#   ... the rest is done by full vectorized sweeps from the current V, as in estimate_V_star's mode 'vectorized'
+# Returns (V, policy, iterCnt) with the policy as an int array, updated in the states that were backed up,
+#   ... (without a 'policy' it's computed from the new V, which takes a full sweep),
+#   ... and iterCnt counting sweep-equivalents, i.e. state backups / nStates (rounded up)
+def resolve_V_star(mdp, gamma, V, policy=None, changed=None, thresh=4, maxIter=10_000, blockSize=256, localBudget=0.1,
+                       callback=None):
+    limit = (10**-thresh) if(thresh is not None) else 0.
+    report = _reporter(callback)
+    if(changed is None):
+        changed, mdp.changedPairs = mdp.changedPairs, set()
+    c = _compiled(mdp)
+    V = np.array(V, dtype=np.float64)
+    pi = None if (policy is None) else _policy_array(c, policy).copy()
+    
+    seeds = np.unique(np.array([st for st,a in changed], dtype=np.int64))
+    residual = np.zeros(c.nStates)
+    if(len(seeds)):
+        Q = Q_states_vec(c, V, seeds, gamma)
+        residual[seeds] = np.abs(Q.max(axis=1) - V[seeds])
+        if(pi is not None):
+            pi[seeds] = _improve_policy(Q, pi[seeds])
+    maxBackups = min(maxIter, localBudget) * c.nStates
+    nBackups = _prioritized_sweeps(c, V, residual, gamma, limit, maxBackups, blockSize, report, pi)
+    iterCnt = -(-nBackups // c.nStates)
+    stop = bool(report and report(iterCnt, residual.max(initial=0.), nBackups))
+    
+    if(not stop and residual.max(initial=0.) >= limit):
+        while(iterCnt < maxIter):
+            Q = Q_vec(c, V, gamma)
+            if(pi is not None):
+                pi = _improve_policy(Q, pi)
+            VV = Q.max(axis=1)
+            diff = np.abs(VV - V).max(initial=0.)
+            V = VV
+            nBackups += c.nStates
+            iterCnt += 1
+            if((report and report(iterCnt, diff, nBackups)) or diff < limit):
+                break
+    
+    if(pi is None):
+        pi = pi_greedy_vec(c, V, gamma)
+    return V, pi, iterCnt
+
+
+
+# Value iteration with MacQueen-Porteus bounds and action elimination
+# After each sweep V' = B[V], the optimal values are bounded in every state by
+#       V' + gamma/(1-gamma) * min(V' - V)   <=   V_star   <=   V' + gamma/(1-gamma) * max(V' - V)
+# An action is dropped for good once an upper bound on its Q-value, R + gamma*P*(upper bound of V_star), falls below 
+#   ... the lower bound of V_star in its state; then its transitions aren't visited again
+# Stops once the error bound, half the width of the bounds, is less than 10**(-thresh),
+#   ... and returns the mid-point of the bounds as V
+# Needs gamma < 1, and transition probs that add up to 1 for every state-action pair
+# 'V' is an optional starting guess (default: zeros)
+# 'callback' is called after every sweep with the error bound as the residual, see SOLVER INSTRUMENTATION
+# Returns (V, iterCnt, errBound, active), where ||V - V_star||_inf <= errBound, 
+#   ... and active is the (nStates, nActions) mask of the actions that weren't eliminated
+def value_iteration_elimination(mdp, gamma, thresh=4, maxIter=10_000, V=None, callback=None):
+    if(not (0 <= gamma < 1)):
+        raise ValueError(f"The bounds need 0 <= gamma < 1, got gamma={gamma} in call to value_iteration_elimination()")
+    limit = (10**-thresh) if(thresh is not None) else 0.
+    c = _compiled(mdp)
+    sums = np.bincount(c.rows(), weights=c.probs, minlength=c.nStates*c.nActions)[c.valid.ravel()]
+    if(np.abs(sums - 1).max(initial=0.) > 1e-9):
+        raise ValueError("The bounds need transition probs that add up to 1, see MDP.normalizeTransitionProbs()")
+    
+    R = c.expected_rewards().ravel()
+    scale = gamma / (1 - gamma)
+    report = _reporter(callback)
+    active = c.valid.copy()
+    
+    def gather():
+        k = np.flatnonzero(active)
+        ptr, idx = csr_gather(c.indptr, k)
+        return k, csr_row_ids(ptr), c.probs[idx], c.next_states[idx]
+    k, rows, probs, nextStates = gather()
+    
+    V = np.zeros(c.nStates) if (V is None) else np.asarray(V, dtype=np.float64)
+    if(maxIter <= 0 or c.nStates == 0):
+        return V, 0, (np.inf if c.nStates else 0.), active
+    cU = None                   # V_star <= V + cU, from the previous sweep
+    errBound = np.inf
+    iterCnt = 0
+    while(iterCnt < maxIter):
+        Q = np.full(c.nStates*c.nActions, -np.inf)
+        Q[k] = R[k] + gamma*np.bincount(rows, weights=probs*V[nextStates], minlength=len(k))
+        Q = Q.reshape(c.nStates, c.nActions)
+        VV = Q.max(axis=1)
+        diff = VV - V
+        newL, newU = scale*diff.min(), scale*diff.max()
+        iterCnt += 1
+        errBound = (newU - newL) / 2
+        
+        if(cU is not None):
+            lower = VV + newL
+            drop = active & (Q + gamma*cU < (lower - 1e-12*(1 + np.abs(lower)))[:,None])
+            if(drop.any()):
+                active &= ~drop
+                k, rows, probs, nextStates = gather()
+        V, cU = VV, newU
+        if((report and report(iterCnt, errBound, iterCnt*c.nStates, Q.argmax(axis=1))) or errBound < limit):
+            break
+    
+    return V + (newL + cU)/2, iterCnt, errBound, active
+
+
+
+
+###############################
+#  PARALLEL VALUE ITERATION
+###############################
+# The arrays of the compiled model and a pair of V-vectors (the current sweep's input and output) live in shared memory
+# Every sweep, a process pool backs up blocks of states (Jacobi-style, reading one V and writing the other),
+#   ... and the end of pool.map() is the barrier after which the block residuals are reduced to their max
+# A sweep gives exactly the same values as B_vec
+
+
+# The shared arrays of this worker process, attached by _attach_shared()
+_shared = {}
+_shared_handles = []
+
+
+def _attach_shared(specs):
+    for name, (shmName, dtype, shape) in specs.items():
+        shm = SharedMemory(name=shmName)
+        _shared_handles.append(shm)
+        _shared[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# Back up the states lo..hi-1 from V[src] into V[1-src], returning the block's max change
+def _backup_block(args):
+    lo, hi, src, gamma = args
+    nActions = _shared['valid'].shape[1]
+    V, VV = _shared['V'][src], _shared['V'][1-src]
+    k0, k1 = _shared['indptr'][lo*nActions], _shared['indptr'][hi*nActions]
+    VV[lo:hi] = B_block_vec(_shared['rows'][k0:k1] - lo*nActions, _shared['probs'][k0:k1], _shared['next_states'][k0:k1],
+                                _shared['R'][lo:hi], _shared['valid'][lo:hi], V, gamma)
+    return np.abs(VV[lo:hi] - V[lo:hi]).max(initial=0.)
+
+
+# Split the states into 'nBlocks' contiguous blocks with about the same no. of transitions
+def _state_blocks(c: CompiledMDP, nBlocks: int) -> list[tuple[int,int]]:
+    perState = c.indptr[::c.nActions]               # the first transition of each state, and nnz at the end
+    bounds = np.searchsorted(perState, np.linspace(0, c.nnz, nBlocks+1), side='left')
+    bounds[0], bounds[-1] = 0, c.nStates
+    bounds = np.unique(np.clip(bounds, 0, c.nStates))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def _estimate_V_star_parallel(mdp, gamma, limit, maxIter, nWorkers, V=None, report=None):
+    c = _compiled(mdp)
+    nWorkers = os.cpu_count() if (nWorkers is None) else int(nWorkers)
+    arrays = {'indptr': c.indptr, 'rows': c.rows(), 'probs': c.probs, 'next_states': c.next_states,
+              'R': c.expected_rewards(), 'valid': c.valid, 'V': np.zeros((2, c.nStates))}
+    if(V is not None):
+        arrays['V'][0] = V
+    
+    handles, specs = [], {}
+    pool = None
+    try:
+        for name, arr in arrays.items():
+            shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+            handles.append(shm)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            specs[name] = (shm.name, arr.dtype.str, arr.shape)
+        V = np.ndarray((2, c.nStates), dtype=np.float64, buffer=handles[-1].buf)
+        
+        pool = multiprocessing.Pool(nWorkers, initializer=_attach_shared, initargs=(specs,))
+        blocks = _state_blocks(c, 4*nWorkers)
+        src = 0
+        iterCnt = 0
+        while(iterCnt < maxIter):
+            diff = max(pool.map(_backup_block, [(lo, hi, src, gamma) for lo,hi in blocks]), default=0.)
+            src = 1 - src
+            iterCnt += 1
+            if((report and report(iterCnt, diff, iterCnt*c.nStates)) or diff < limit):
+                break
+        return V[src].copy(), iterCnt
+    
+    finally:
+        if(pool is not None):
+            pool.terminate()
+            pool.join()
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+
+# Make the policy 'pi' greedy w.r.t. the Q-values 'Q', as an (nStates, nActions) array from Q_vec
+# A state keeps its current action while that ties with the best one, so that a stable policy is detected as such
+def _improve_policy(Q, pi) -> np.ndarray:
+    bigA = Q.argmax(axis=1)
+    if(pi is None):
+        return bigA
+    idx = np.arange(len(bigA))
+    bigQ = Q[idx, bigA]
+    keep = Q[idx, pi] >= bigQ - 1e-12*(1 + np.abs(bigQ))
+    return np.where(keep, pi, bigA)
+
+
+# Policy Iteration
+# Alternately evaluate the current policy (see estimate_V_pi and its 'method') and make it greedy w.r.t. its state-values
+# Starts from 'policy' if given, else from the greedy policy of 'V' (default: zeros)
+# Every evaluation is warm-started from the previous state-values
+# Stops as soon as the greedy policy is stable, or after 'maxIter' improvements
+# 'callback' is called after every improvement with the Bellman residual ||B[V] - V||_inf, see SOLVER INSTRUMENTATION
+# Returns (V, policy, iterCnt) with the policy as an int array, and iterCnt the number of evaluations done
+def policy_iteration(mdp, gamma, policy=None, V=None, thresh=4, maxIter=1_000, method='auto', callback=None):
+    c = _compiled(mdp)
+    V = np.zeros(c.nStates) if (V is None) else np.asarray(V, dtype=np.float64)
+    pi = _policy_array(c, policy) if (policy is not None) else pi_greedy_vec(c, V, gamma)
+    report = _reporter(callback, pi)
+    nBackups = 0
+    iterCnt = 0
+    while(iterCnt < maxIter):
+        V, evalCnt = estimate_V_pi(mdp, pi, gamma, thresh=thresh, method=method, V=V)
+        iterCnt += 1
+        Q = Q_vec(c, V, gamma)
+        new_pi = _improve_policy(Q, pi)
+        if(report):
+            nBackups += (evalCnt + 1) * c.nStates
+            if(report(iterCnt, np.abs(Q.max(axis=1) - V).max(initial=0.), nBackups, new_pi)):
+                pi = new_pi
+                break
+        if((new_pi == pi).all()):
+            break
+        pi = new_pi
+    
+    return V, pi, iterCnt
+
+
+# Modified Policy Iteration
+# Like policy_iteration, but each policy is evaluated only partially, by 'm' B_pi sweeps from the previous state-values
+#   ... m=1 gives value iteration, and m -> infinity gives policy iteration
+# Stops once the greedy policy is stable and the Bellman residual ||B[V] - V||_inf is less than 10**(-thresh)
+# set thresh=None to not consider a threshold, running till 'maxIter' is exhausted
+# 'callback' is called after every improvement with the Bellman residual, see SOLVER INSTRUMENTATION
+# Returns (V, policy, iterCnt) with the policy as an int array, and iterCnt the number of improvements done
+def modified_policy_iteration(mdp, gamma, m=20, policy=None, V=None, thresh=4, maxIter=10_000, callback=None):
+    if(m < 1):
+        raise ValueError(f"Expected at least 1 sweep per evaluation, got m={m} in call to modified_policy_iteration()")
+    limit = (10**-thresh) if(thresh is not None) else 0.
+    c = _compiled(mdp)
+    V = np.zeros(c.nStates) if (V is None) else np.asarray(V, dtype=np.float64)
+    pi = _policy_array(c, policy) if (policy is not None) else None
+    report = _reporter(callback, pi)
+    idx = np.arange(c.nStates)
+    iterCnt = 0
+    while(iterCnt < maxIter):
+        Q = Q_vec(c, V, gamma)
+        new_pi = _improve_policy(Q, pi)
+        BV = Q[idx, new_pi]             # the first B_pi sweep of the new policy is the backup B[V]
+        diff = np.abs(BV - V).max(initial=0.)
+        stable = (pi is not None) and (new_pi == pi).all()
+        pi = new_pi
+        iterCnt += 1
+        if((report and report(iterCnt, diff, iterCnt*m*c.nStates, pi)) or (stable and diff < limit)):
+            V = BV
+            break
+        V = Bpi_k_vec(c, m-1, BV, pi, gamma)
+    
+    return V, pi, iterCnt
+
+
+# Finite-horizon backward induction
+# The optimal values and (non-stationary) policy of episodes of 'horizon' steps, with the reward of step t discounted
+#   ... by gamma**t (gamma=1 by default, as in MDP_Iterator and MDP_Iterators.simulate_batch)
+# Works back from t = horizon-1 to 0 with one vectorized backup of all states per step: V_t = max_a Q^{V_t+1}(s,a)
+# 'V_T' are the terminal values after the last step, a scalar or an nStates-vector (default: zeros)
+# 'compact' keeps only V_0 instead of every V_t, and stores the policy of each step as int16 (int32 for more than
+#   ... 2**15 actions) instead of int64, so that a long horizon needs just 2 or 4 bytes per state per step
+# Returns (V, pi):
+#       V   :  a (horizon+1, nStates) array with V[t] the optimal value-to-go from step t (and V[horizon] = V_T),
+#              ... or just V_0 as an nStates-vector if compact
+#       pi  :  a (horizon, nStates) int array with pi[t][s] the optimal action in state 's' at step t
+# Ties go to the lowest-numbered action, same as pi_greedy_vec()
+def finite_horizon_V_star(mdp, horizon: int, gamma=1., V_T=0., compact=False):
+    if(horizon < 0):
+        raise ValueError(f"Unknown value for arg 'horizon': {horizon} in call to finite_horizon_V_star()")
+    c = _compiled(mdp)
+    VT = np.broadcast_to(np.asarray(V_T, dtype=np.float64), (c.nStates,))
+    if(compact):
+        piType = np.int16 if (c.nActions <= 2**15) else np.int32
+        pi = np.empty((horizon, c.nStates), dtype=piType)
+        V = VT.copy()
+    else:
+        pi = np.empty((horizon, c.nStates), dtype=np.int64)
+        Vt = np.empty((horizon+1, c.nStates))
+        Vt[horizon] = VT
+        V = Vt[horizon]
+
+    for t in range(horizon-1, -1, -1):
+        V, pi[t] = Qmax_vec(c, V, gamma)
+        if(not compact):
+            Vt[t] = V
+
+    return (V, pi) if compact else (Vt, pi)
@@ -0,0 +1,155 @@
+import numpy as np
+
+from MDP import MDP
+from SparseUtils import csr_gather
+from BellmanBackup import _compiled, policy_to_array
+
+# Model minimization by bisimulation
+# Two states are bisimilar when they have the same possible actions, the same expected reward for each action, and
+#   ... for each action the same probability of moving into each block of bisimilar states
+# Bisimilar states have the same optimal values (and the same V_pi under policies that agree on them), so an MDP
+#   ... can be solved on its quotient, which has one state per block, and the solution lifted back
+#
+#       reduced, blockOf = minimize(mdp)
+#       Vq, iterCnt = estimate_V_star(reduced, gamma)
+#       V = lift_V(Vq, blockOf)                                 # == estimate_V_star(mdp, gamma) to within thresh
+#       pi = lift_policy(pi_greedy_vec(reduced, Vq, gamma), blockOf)
+
+
+
+# The coarsest bisimulation partition of the states of 'mdp', by partition refinement on its compiled model
+# Probabilities and expected rewards are compared after rounding them to multiples of 'tol'
+# Each round splits the blocks by a signature of every state's (action, block, prob) transitions, which is a
+#   ... sum of 64-bit hashes; the final partition is checked exactly, and refined again if a hash collision merged any states
+# Returns (nBlocks, blockOf), blockOf[st] being the block of state 'st', with blocks numbered by their lowest state
+def bisimulation_partition(mdp, tol=1e-9) -> tuple[int, np.ndarray]:
+    c = _compiled(mdp)
+    nStates = c.nStates
+    rows = c.rows()
+    qR = np.rint(c.expected_rewards() / tol).astype(np.int64)
+    _, blockOf = np.unique(np.concatenate((c.valid, qR), axis=1), axis=0, return_inverse=True)
+    blockOf = blockOf.reshape(-1)
+    nBlocks = int(blockOf.max(initial=-1)) + 1
+
+    salt = 0
+    while(True):
+        while(True):
+            st, a, b, q = _block_transitions(c, rows, blockOf, nBlocks, tol)
+            sig = _signatures(st, a, b, q, nStates, salt)
+            blockOf, newBlocks = _relabel(blockOf, sig)
+            if(newBlocks == nBlocks):
+                break
+            nBlocks = newBlocks
+
+        blockOf, reps = _canonical(blockOf, nBlocks)
+        mixed = _mixed_blocks(st, a, b, q, blockOf, reps, nStates)
+        if(not mixed.any()):
+            return nBlocks, blockOf
+        salt += 1
+
+
+# The quotient of 'mdp' by its bisimulation partition (see bisimulation_partition), as an MDP with one state per block
+# Each block takes its state-label and transitions from its lowest state, with next-states replaced by their blocks
+#   ... (transitions into the same block with the same reward are merged)
+# Returns (reduced, blockOf), blockOf[st] being the state of 'reduced' that the state 'st' of 'mdp' maps to
+def minimize(mdp: MDP, tol=1e-9) -> tuple[MDP, np.ndarray]:
+    nBlocks, blockOf = bisimulation_partition(mdp, tol)
+    c = _compiled(mdp)
+    _, reps = np.unique(blockOf, return_index=True)                 # the lowest state of each block
+
+    rows = c.rows()
+    st = rows // c.nActions
+    keep = reps[blockOf[st]] == st
+    st, a = blockOf[st[keep]], rows[keep] % c.nActions
+    p, s, r = c.probs[keep], blockOf[c.next_states[keep]], c.rewards[keep]
+
+    order = np.lexsort((r, s, a, st))
+    st, a, p, s, r = st[order], a[order], p[order], s[order], r[order]
+    new = np.ones(len(st), dtype=bool)
+    new[1:] = (st[1:] != st[:-1]) | (a[1:] != a[:-1]) | (s[1:] != s[:-1]) | (r[1:] != r[:-1])
+    starts = np.flatnonzero(new)
+    p = np.add.reduceat(p, starts) if len(starts) else p
+
+    states = [mdp.states[i] for i in reps.tolist()]
+    reduced = MDP.from_arrays(states, list(mdp.actions), st[starts], a[starts], p, s[starts], r[starts], tol=None)
+    return reduced, blockOf
+
+
+# The state-values of the original MDP from those of its quotient, V[st] = Vq[blockOf[st]]
+def lift_V(Vq, blockOf: np.ndarray) -> np.ndarray:
+    return np.asarray(Vq, dtype=np.float64)[blockOf]
+
+
+# A policy of the original MDP from one of its quotient, acting in every state as in its block
+# Takes and returns a policy as an int array (or a dict s -> a, which gives a dict back)
+def lift_policy(policy, blockOf: np.ndarray):
+    pi = policy_to_array(policy, blockOf.max(initial=-1) + 1)[blockOf]
+    return pi if isinstance(policy, np.ndarray) else dict(enumerate(pi.tolist()))
+
+
+
+# The transitions of the compiled model 'c' summed up by (state, action, next block), sorted by state
+# Returns the arrays (st, a, b, q) with q the summed prob rounded to a multiple of 'tol', as an int
+def _block_transitions(c, rows, blockOf, nBlocks, tol):
+    keys = rows * nBlocks + blockOf[c.next_states]
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    probs = np.bincount(inverse, weights=c.probs, minlength=len(uniq))
+    k, b = np.divmod(uniq, nBlocks)
+    st, a = np.divmod(k, c.nActions)
+    return st, a, b, np.rint(probs / tol).astype(np.int64)
+
+
+# A 64-bit signature of each state's (a, b, q) triplets, the sum of their hashes (so it doesn't depend on their order)
+def _signatures(st, a, b, q, nStates, salt):
+    h = _mix(np.full(len(st), salt, dtype=np.uint64) + a.astype(np.uint64))
+    h = _mix(h + b.astype(np.uint64))
+    h = _mix(h + q.astype(np.uint64))
+    sig = np.zeros(nStates, dtype=np.uint64)
+    counts = np.bincount(st, minlength=nStates)
+    nonEmpty = np.flatnonzero(counts)
+    if(len(nonEmpty)):
+        starts = np.concatenate(([0], np.cumsum(counts[nonEmpty])[:-1]))
+        sig[nonEmpty] = np.add.reduceat(h, starts)
+    return sig
+
+
+# splitmix64, applied elementwise (uint64 arithmetic wraps around)
+def _mix(x):
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+# Split every block by the signature of its states, returns (blockOf, nBlocks) of the finer partition
+def _relabel(blockOf, sig):
+    order = np.lexsort((sig, blockOf))
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = (blockOf[order][1:] != blockOf[order][:-1]) | (sig[order][1:] != sig[order][:-1])
+    labels = np.empty(len(order), dtype=np.int64)
+    labels[order] = np.cumsum(new) - 1
+    return labels, int(new.sum())
+
+
+# Renumber the blocks in the order of their lowest state, returns (blockOf, reps) with reps[i] the lowest state of block 'i'
+def _canonical(blockOf, nBlocks):
+    _, first, inverse = np.unique(blockOf, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(nBlocks, dtype=np.int64)
+    rank[order] = np.arange(nBlocks)
+    return rank[inverse.reshape(-1)], first[order]
+
+
+# The states whose (a, b, q) triplets differ from those of the lowest state of their block, as a bool array
+def _mixed_blocks(st, a, b, q, blockOf, reps, nStates):
+    counts = np.bincount(st, minlength=nStates)
+    rep = reps[blockOf]
+    mixed = counts != counts[rep]
+    if(mixed.any()):
+        return mixed
+    indptr = np.zeros(nStates+1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    _, idx = csr_gather(indptr, rep)
+    diff = (a[idx] != a) | (b[idx] != b) | (q[idx] != q)
+    mixed[st[diff]] = True
+    return mixed
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import struct
+import tempfile
+
+import numpy as np
+
+from MDP import MDP
+from BellmanBackup import estimate_V_star, estimate_V_pi, pi_greedy_vec, policy_to_array
+
+# Checkpointing for long solves
+# checkpointed_V_star() and checkpointed_V_pi() run estimate_V_star / estimate_V_pi in segments of upto 'every' sweeps
+#   ... (or 'seconds' of wall-clock time), saving the state of the solve to a file after each segment
+# resume() picks a solve up again from its file, after checking that the model is still the same (see MDP.fingerprint)
+# The values in a checkpoint can also warm-start a solve of a changed model, see resume(strict=False)
+#
+#       V, iterCnt = checkpointed_V_star(mdp, 0.99, "solve.ckpt", seconds=600)
+#       ... the process dies, and after a restart:
+#       V, iterCnt = resume(mdp, "solve.ckpt")
+
+
+
+CHECKPOINT_MAGIC = b"MDP-CKPT"
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint:
+    # The state of a solve, as saved by save_checkpoint()
+    #   'kind'         :  'V_star' or 'V_pi'
+    #   'V'            :  the state-values so far, a float64 array
+    #   'policy'       :  an int array, the greedy policy of V for 'V_star', and the policy being evaluated for 'V_pi'
+    #   'iterCnt'      :  the sweeps done so far, in the units of the solver's iterCnt
+    #   'settings'     :  the args of the solver, e.g. {'gamma': 0.99, 'thresh': 4, 'maxIter': 10000, 'mode': 'vectorized'}
+    #   'fingerprint'  :  the fingerprint of the MDP being solved, see MDP.fingerprint()
+    #   'done'         :  True once the solve has met its threshold
+
+    def __init__(self, kind, V, policy, iterCnt, settings, fingerprint, done=False):
+        self.kind = kind
+        self.V = V
+        self.policy = policy
+        self.iterCnt = iterCnt
+        self.settings = settings
+        self.fingerprint = fingerprint
+        self.done = done
+
+    def __repr__(self):
+        return f"Checkpoint({self.kind}, {len(self.V)} states, iterCnt={self.iterCnt}, done={self.done})"
+
+
+# The file format is:
+#       CHECKPOINT_MAGIC,
+#       the length of the header as a little-endian uint64,
+#       the header, as json: {version_no, kind, iterCnt, settings, fingerprint, done, arrays: {name: {dtype, shape, offset}}}
+#       the arrays V and policy, each at its offset from the end of the header
+# The file is written under a temporary name in the same directory and then renamed over 'filename',
+#   ... so a crash leaves either the old checkpoint or the new one, never a partial file
+def save_checkpoint(filename, ckpt: Checkpoint) -> None:
+    arrays = {'V': np.ascontiguousarray(ckpt.V, dtype='<f8'), 'policy': np.ascontiguousarray(ckpt.policy, dtype='<i8')}
+    header = {'version_no'   :  CHECKPOINT_VERSION,
+              'kind'         :  ckpt.kind,
+              'iterCnt'      :  int(ckpt.iterCnt),
+              'settings'     :  ckpt.settings,
+              'fingerprint'  :  ckpt.fingerprint,
+              'done'         :  bool(ckpt.done),
+              'arrays'       :  {}}
+    offset = 0
+    for name, arr in arrays.items():
+        header['arrays'][name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset += arr.nbytes
+    headerBytes = json.dumps(header).encode()
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmpName = tempfile.mkstemp(dir=directory, prefix=".ckpt-")
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            outfile.write(CHECKPOINT_MAGIC)
+            outfile.write(struct.pack("<Q", len(headerBytes)))
+            outfile.write(headerBytes)
+            for arr in arrays.values():
+                outfile.write(arr.tobytes())
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmpName, filename)
+    except BaseException:
+        if(os.path.exists(tmpName)):
+            os.remove(tmpName)
+        raise
+
+
+def load_checkpoint(filename) -> Checkpoint:
+    with open(filename, "rb") as infile:
+        if(infile.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC):
+            raise ValueError(f"The file '{filename}' isn't a checkpoint")
+        (headerLen,) = struct.unpack("<Q", infile.read(8))
+        header = json.loads(infile.read(headerLen))
+        data = infile.read()
+    if(header['version_no'] != CHECKPOINT_VERSION):
+        raise ValueError(f"Encoding mismatch while trying to load '{filename}'. "
+                         f"Expected version '{CHECKPOINT_VERSION}', got version '{header['version_no']}'")
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        count = int(np.prod(spec['shape']))
+        arrays[name] = np.frombuffer(data, dtype=spec['dtype'], count=count, offset=spec['offset']).reshape(spec['shape']).copy()
+    return Checkpoint(header['kind'], arrays['V'], arrays['policy'], header['iterCnt'], header['settings'],
+                          header['fingerprint'], header['done'])
+
+
+
+# estimate_V_star (see its args), saving a checkpoint to 'filename' every 'every' sweeps and/or 'seconds' seconds,
+#   ... and once more at the end
+# Mode 'topological' isn't supported, since its maxIter bounds the sweeps of each block rather than of the whole solve
+# 'callback' is called as in estimate_V_star, with iterCnt and elapsed counted over the whole solve
+# Returns (V, iterCnt) like estimate_V_star
+def checkpointed_V_star(mdp: MDP, gamma, filename, every=100, seconds=None, thresh=4, maxIter=10_000, mode='vectorized',
+                            nWorkers=None, blockSize=256, V=None, callback=None):
+    if(mode == 'topological'):
+        raise ValueError(f"Unknown value for arg 'mode': {mode} in call to checkpointed_V_star()")
+    settings = {'gamma': gamma, 'thresh': thresh, 'maxIter': maxIter, 'mode': mode, 'nWorkers': nWorkers,
+                'blockSize': blockSize}
+    ckpt = Checkpoint('V_star', V, None, 0, settings, mdp.fingerprint())
+    return _run(mdp, ckpt, filename, every, seconds, callback)
+
+
+# estimate_V_pi (see its args), checkpointed as in checkpointed_V_star()
+def checkpointed_V_pi(mdp: MDP, policy, gamma, filename, every=100, seconds=None, thresh=4, maxIter=10_000,
+                          method='iterate', V=None, callback=None):
+    settings = {'gamma': gamma, 'thresh': thresh, 'maxIter': maxIter, 'method': method}
+    ckpt = Checkpoint('V_pi', V, policy_to_array(policy, mdp.nStates), 0, settings, mdp.fingerprint())
+    return _run(mdp, ckpt, filename, every, seconds, callback)
+
+
+# Continue the solve saved in the checkpoint 'filename', with its settings, saving further checkpoints to the same file
+# 'maxIter', if given, replaces the total no. of sweeps allowed
+# With strict=True the MDP must have the fingerprint of the checkpoint, else a ValueError is raised
+# With strict=False the checkpoint just needs the same no. of states, and its values warm-start a solve of the changed model
+# Returns (V, iterCnt) like the solver, straight away if the checkpoint is of a finished solve of the same model
+def resume(mdp: MDP, filename, maxIter=None, every=100, seconds=None, strict=True, callback=None):
+    ckpt = load_checkpoint(filename)
+    fingerprint = mdp.fingerprint()
+    if(ckpt.fingerprint != fingerprint):
+        if(strict):
+            raise ValueError(f"The checkpoint '{filename}' is of a different model: "
+                             f"fingerprint {ckpt.fingerprint} != {fingerprint}, see resume(strict=False)")
+        if(len(ckpt.V) != mdp.nStates):
+            raise ValueError(f"The checkpoint '{filename}' has {len(ckpt.V)} state-values, but the model has {mdp.nStates} states")
+        ckpt.fingerprint, ckpt.done = fingerprint, False
+    if(maxIter is not None):
+        ckpt.settings['maxIter'] = maxIter
+    if(ckpt.done):
+        return ckpt.V, ckpt.iterCnt
+    return _run(mdp, ckpt, filename, every, seconds, callback)
+
+
+# Run the solve of 'ckpt' in segments from where it is, saving it after each segment
+def _run(mdp, ckpt, filename, every, seconds, callback):
+    settings = ckpt.settings
+    gamma, thresh, maxIter = settings['gamma'], settings['thresh'], settings['maxIter']
+    limit = (10**-thresh) if(thresh is not None) else 0.
+    t0 = time.perf_counter()
+    V = ckpt.V
+    while(ckpt.iterCnt < maxIter):
+        segStart = ckpt.iterCnt
+        userStop, timeUp = False, False
+        lastResidual = np.inf
+        def watch(iterCnt, residual, elapsed, nBackups, policyChanges):
+            nonlocal userStop, timeUp, lastResidual
+            lastResidual = residual
+            if(callback is not None and callback(segStart + iterCnt, residual, time.perf_counter() - t0, nBackups, policyChanges)):
+                userStop = True
+            timeUp = (seconds is not None) and (elapsed >= seconds)
+            return userStop or timeUp
+
+        segment = min(every, maxIter - ckpt.iterCnt) if (every is not None) else maxIter - ckpt.iterCnt
+        if(ckpt.kind == 'V_star'):
+            V, iterCnt = estimate_V_star(mdp, gamma, thresh=thresh, maxIter=segment, mode=settings['mode'],
+                                             nWorkers=settings['nWorkers'], blockSize=settings['blockSize'], V=V, callback=watch)
+        else:
+            V, iterCnt = estimate_V_pi(mdp, ckpt.policy, gamma, thresh=thresh, maxIter=segment, method=settings['method'],
+                                           V=V, callback=watch)
+
+        # a segment that ends early without being stopped has met the threshold
+        #   ... as has one that did more sweeps than asked for (mode 'python' checks every 100 sweeps) on its last check
+        ckpt.iterCnt += iterCnt
+        ckpt.done = (iterCnt < segment or lastResidual < limit) and not (userStop or timeUp)
+        ckpt.V = np.asarray(V, dtype=np.float64)
+        if(ckpt.kind == 'V_star'):
+            ckpt.policy = pi_greedy_vec(mdp, ckpt.V, gamma)
+        save_checkpoint(filename, ckpt)
+        if(ckpt.done or userStop):
+            break
+
+    return V, ckpt.iterCnt
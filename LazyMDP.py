@@ -0,0 +1,157 @@
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+
+import numpy as np
+
+from MDP import MDP
+
+# An MDP given by a generative model rather than by its tables, for models whose nominal state space
+#   ... is much bigger than the part reachable from the start states
+#
+#       def model(state):           # state -> {action: [(p, next_state, reward), ..]}
+#           ...
+#       lazy = LazyMDP(model, start=[initial_state])
+#       lazy.explore()              # BFS over the reachable states
+#       mdp = lazy.to_mdp()         # a regular MDP over just those states
+
+
+
+class LazyMDP:
+    # 'model' is a callable, model(state) -> {action: [(p1,s1,r1), (p2,s2,r2), ..]}, giving for every possible action
+    #   ... of 'state' its transitions as in MDP.transitions, with states and actions given by their (hashable) labels
+    #   ... A state with no way out should be given an absorbing transition, e.g. {a: [(1.0, state, 0.)]}
+    # 'start' is a list of start states (labels)
+    # 'actions' is the list of action labels, or None to number the actions in the order that the model first gives them
+    # 'maxCached' bounds the no. of expanded states whose transitions are kept, least recently used ones being dropped
+    #   ... (and asked of the model again when next needed)
+    # States are numbered in the order they're discovered (the start states first), so the numbers of a state
+    #   ... here, in self.to_mdp() and in its compiled model are all the same
+
+    def __init__(self, model, start: list, actions=None, maxCached=100_000):
+        self.model = model
+        self.maxCached = maxCached
+        self.states = []            # the state labels, in the order they were discovered
+        self.index = {}             # state label -> state no.
+        self.actions = [] if (actions is None) else list(actions)
+        self.actionIndex = {a : i for i,a in enumerate(self.actions)}
+        self._fixedActions = actions is not None
+        self.nModelCalls = 0
+
+        self._cache = OrderedDict()         # state no. -> {action no. : [(p, next state no., r)]}, least recently used first
+        self._samplers = {}                 # (st,a) -> cumulative probs, see self.next_state_and_reward()
+        self.nExplored = 0                  # explore() has expanded the states 0..nExplored-1, which is a BFS order
+        self._arrays = (array('q'), array('q'), array('d'), array('q'), array('d'))    # st, a, p, s, r of those states
+
+        for label in start:
+            self._addState(label)
+        if(not self.states):
+            raise ValueError(f"Unknown value for arg 'start': {start} in call to LazyMDP.__init__()")
+
+    def __getattr__(self, name):
+        if(name=='nStates'):                # the states discovered so far
+            return len(self.states)
+        elif(name=='nActions'):
+            return len(self.actions)
+        elif(name=='nFrontier'):            # the states discovered but not explored yet
+            return len(self.states) - self.nExplored
+
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def __repr__(self):
+        return f"LazyMDP({self.nStates} states discovered, {self.nExplored} explored, {self.nActions} actions)"
+
+
+    def _addState(self, label) -> int:
+        st = self.index.get(label)
+        if(st is None):
+            st = self.index[label] = len(self.states)
+            self.states.append(label)
+        return st
+
+    def _addAction(self, label, state) -> int:
+        a = self.actionIndex.get(label)
+        if(a is None):
+            if(self._fixedActions):
+                raise ValueError(f"The model gave an unknown action '{label}' in state '{state}'")
+            a = self.actionIndex[label] = len(self.actions)
+            self.actions.append(label)
+        return a
+
+    # The transitions of every possible action of state no. 'st', as {a: [(p,s,r), ..]} with actions and states numbered
+    # Asks the model only if they aren't cached, and numbers any new states it gives
+    def expand(self, st: int) -> dict[int, list[tuple[float,int,float]]]:
+        trans = self._cache.get(st)
+        if(trans is not None):
+            self._cache.move_to_end(st)
+            return trans
+
+        label = self.states[st]
+        out = self.model(label)
+        self.nModelCalls += 1
+        if(not out):
+            raise ValueError(f"The model gave no actions for state '{label}', give it an absorbing transition instead")
+        trans = {}
+        for aLabel, triplets in out.items():
+            a = self._addAction(aLabel, label)
+            trans[a] = [(float(p), self._addState(s), float(r)) for p,s,r in triplets]
+            if(not trans[a] or any(p < 0 for p,s,r in trans[a])):
+                raise ValueError(f"The model gave some invalid transitions for ('{label}', '{aLabel}'): {triplets}")
+
+        self._cache[st] = trans
+        while(len(self._cache) > self.maxCached):
+            old, oldTrans = self._cache.popitem(last=False)
+            for a in oldTrans:
+                self._samplers.pop((old, a), None)
+        return trans
+
+    # Return an iterator over possible actions in state no. 'st', as MDP.possibleActions()
+    def possibleActions(self, st: int):
+        return iter(sorted(self.expand(st)))
+
+    # get the next_state and reward for state no. 'state' and action no. 'action', as MDP.next_state_and_reward(),
+    #   ... expanding the state on demand, so that the model can be simulated without exploring it
+    def next_state_and_reward(self, state, action, x: float) -> tuple[int,float]:
+        probs = self.expand(state)[action]
+        cumprobs = self._samplers.get((state,action))
+        if(cumprobs is None):
+            cumprobs = self._samplers[state,action] = list(accumulate(p for (p,s,r) in probs))
+        i = bisect_right(cumprobs, x)
+        if(i == len(cumprobs)):
+            msg = f"Value '{x}' wasn't reached on adding probs[{state},{action}]: {probs}, total={cumprobs[-1]}"
+            raise RuntimeError(msg)
+        p,s,r = probs[i]
+        return s,r
+
+
+    # Explore the reachable states breadth-first from the start states, expanding every discovered state once
+    # Stops once every reachable state is explored, or once 'maxStates' states are explored (it can be called again to go on)
+    # The transitions of the explored states are kept in compact arrays (not in the bounded cache), for self.to_arrays()
+    # Returns True iff every reachable state has been explored
+    def explore(self, maxStates=None) -> bool:
+        st, a, p, s, r = self._arrays
+        while(self.nExplored < len(self.states) and (maxStates is None or self.nExplored < maxStates)):
+            src = self.nExplored
+            for act, triplets in sorted(self.expand(src).items()):
+                for prob, nextState, reward in triplets:
+                    st.append(src)
+                    a.append(act)
+                    p.append(prob)
+                    s.append(nextState)
+                    r.append(reward)
+            self.nExplored += 1
+        return self.nExplored == len(self.states)
+
+    # The explored model as arrays (st, a, p, s, r) with one element per transition, for MDP.from_arrays()
+    # Explores the rest of the reachable states first, if need be
+    def to_arrays(self) -> tuple[np.ndarray, ...]:
+        self.explore()
+        return tuple(np.frombuffer(arr, dtype=arr.typecode.replace('q', 'i8').replace('d', 'f8')).copy()
+                         for arr in self._arrays)
+
+    # The explored model as a regular MDP over the reachable states (built from arrays, see MDP.from_arrays)
+    # 'tol' : the probs of every state-action pair must add up to 1 within 'tol' (set tol=None to skip this check)
+    def to_mdp(self, tol=1e-6) -> MDP:
+        st, a, p, s, r = self.to_arrays()
+        return MDP.from_arrays(list(self.states), list(self.actions), st, a, p, s, r, tol=tol)
@@ -1,7 +1,17 @@
 
+import os
 import json
+import struct
+import hashlib
+import tempfile
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+
+import numpy as np
 
 from MarkovChain import MarkovChain
+from SparseUtils import csr_row_ids, csr_gather, strongly_connected_components
 
 class MDP:
     # A Markov Decision Process 
@@ -18,6 +28,14 @@ class MDP:
         #   ... it maps a key of state-action pair to a list of triplets (p,s,r)
         #   ... where 'p' is the probability of this transition, 's' is the new state, 'r' is the reward obtained
         #   ... This way, you could have multiple transitions to the same new state, but with different rewards (each with a given prob)
+        # self.transitions is kept as a TransitionsDict, so that setting (or deleting) the transitions of a pair in it
+        #   ... is picked up like a call to self.setTransition(); mutating a pair's list in place isn't, see TransitionsDict
+        
+        self._compiled = None      # cached CompiledMDP, see self.compile()
+        self._staleCompiled = None # the last compiled model, after an edit to self.transitions dropped it, see self._pairChanged()
+        self._samplers = {}        # cached (st,a) -> (cumulative probs, transitions), see self.next_state_and_reward()
+        self.policyCache = PolicyCache()    # results computed per policy (and gamma), see PolicyCache
+        self.changedPairs = set()           # the (st,a) pairs modified since they were last consumed, see self.setTransition()
         
         if(type(states)==int):
             self.states = [f"State-{i}" for i in range(states)]
@@ -45,7 +63,7 @@ class MDP:
         
         if(transitions is None):
             self.transitions = None
-        elif(type(transitions) == dict):
+        elif(isinstance(transitions, dict)):
             self.setTransitions(transitions)
         else:
             raise TypeError(f"Unknown value for arg 'transitions': {transitions}\
@@ -55,13 +73,17 @@ class MDP:
     # Return an iterator over possible actions in state 'st'
     # See a usage example in self.set_joint_probs
     def possibleActions(self, st: int):
-        return ( (i) for i in range(self.nActions) if (i in self.state_action_pairs[st]) )
+        return iter(sorted(self.state_action_pairs[st]))
     
     def __getattr__(self, name):
         if(name=='nStates'):
             return len(self.states)
         elif(name=='nActions'):
             return len(self.actions)
+        elif(name in ('state_action_pairs', 'transitions') and self.__dict__.get('_compiled') is not None):
+            # an MDP made from arrays (e.g. loaded from a binary file) builds its dicts only when they're first needed
+            self._materialize()
+            return self.__dict__[name]
         
         raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
         
@@ -97,11 +119,17 @@ class MDP:
                         for st in invalid_actions.keys()].join(", \t\t")
             raise ValueError(msg)
         
+        if(self.__dict__.get('_compiled') is not None):
+            self._materialize()
+        old = self.__dict__.get('state_action_pairs')
+        if(old is not None):
+            self.changedPairs.update((st,a) for st in range(self.nStates) for a in old[st] ^ set(sa_pairs[st]))
         self.state_action_pairs = sa_pairs
+        self._invalidate()
         
         
     def setTransitions(self, transitions : dict[  tuple[int,int],  list[tuple[float,int,float]]  ]) -> None:
-        if(type(transitions) != dict):
+        if(not isinstance(transitions, dict)):
             raise ValueError(f"The given Transitions data: '{transitions}' " + \
                                  "is not a python dictionary")
         
@@ -112,7 +140,7 @@ class MDP:
                                  f"contains some invalid states: '{invalid_states}'")
             
         # Collect all transitions.keys() that have invalid actions for that state
-        invalid_actions = [(st,a) for (st,a) in transitions.keys() if a not in self.possibleActions(st)]
+        invalid_actions = [(st,a) for (st,a) in transitions.keys() if a not in self.state_action_pairs[st]]
         if(len(invalid_actions)):
             raise ValueError(f"The given Transitions data: '{transitions}' " + \
                                  f"contains some invalid action: '{invalid_actions}'")
@@ -131,7 +159,67 @@ class MDP:
         if(len(invalid_next_states)):
             raise ValueError(f"The given Transitions data had some invalid next-states: '{invalid_next_states}'")
 
-        self.transitions = transitions
+        if(self.__dict__.get('_compiled') is not None):
+            self._materialize()
+        old = self.__dict__.get('transitions')
+        if(old is transitions):
+            # the dict was edited in place, so compare it with the model as it was last compiled, if it was
+            #   ... which also catches the lists of pairs that were mutated in place
+            c = self.__dict__.get('_compiled')
+            c = self.__dict__.get('_staleCompiled') if (c is None) else c
+            self.changedPairs.update(transitions.keys() if (c is None) else self._changedSince(c, transitions))
+        else:
+            if(old is not None):
+                self.changedPairs.update(k for k in old.keys() | transitions.keys() if old.get(k) != transitions.get(k))
+            self.transitions = TransitionsDict(transitions, self)
+        self._invalidate()
+    
+    # The (st,a) pairs whose transitions in the dict 'transitions' differ from those in the compiled model 'c'
+    def _changedSince(self, c, transitions) -> set:
+        probs, nextStates, rewards = c.probs.tolist(), c.next_states.tolist(), c.rewards.tolist()
+        indptr = c.indptr.tolist()
+        changed = {(k//self.nActions, k%self.nActions) for k in np.flatnonzero(c.valid.ravel()).tolist()}
+        changed -= transitions.keys()
+        for (st,a),trans in transitions.items():
+            k = st*self.nActions + a
+            k0, k1 = indptr[k], indptr[k+1]
+            row = list(zip(probs[k0:k1], nextStates[k0:k1], rewards[k0:k1]))
+            if(not c.valid[st,a] or [tuple(t) for t in trans] != row):
+                changed.add((st,a))
+        return changed
+    
+    # Replace the transitions of one state-action pair (st,a) with a list of triplets (p,s,r), as in setTransitions
+    # Pass transitions=None after editing self.transitions[st,a] in place, to have the edit picked up
+    # Unlike setTransitions, a compiled model is patched rather than rebuilt (see CompiledMDP.replace_rows)
+    # Every modified pair is recorded in self.changedPairs, so that a solved model can be re-solved
+    #   ... incrementally, see BellmanBackup.resolve_V_star()
+    def setTransition(self, st: int, a: int, transitions=None) -> None:
+        c = self.__dict__.get('_compiled')
+        if(st not in range(self.nStates)):
+            raise ValueError(f"Unknown value for arg 'st': {st} in call to MDP.setTransition()")
+        if(c is not None and 'state_action_pairs' not in self.__dict__):
+            possible = a in range(self.nActions) and c.valid[st,a]
+        elif(self.state_action_pairs is not None and self.transitions is not None):
+            possible = a in self.state_action_pairs[st]
+        else:
+            raise ValueError(f"Can't set the transitions of ({st},{a}) before all the transitions of {self!r} are set")
+        if(not possible):
+            raise ValueError(f"The given action '{a}' isn't possible in state '{st}', in call to MDP.setTransition()")
+        
+        transitions = list(self.transitions[st,a] if (transitions is None) else transitions)
+        invalid_next_states = [s for p,s,r in transitions if s not in range(self.nStates)]
+        if(len(invalid_next_states)):
+            raise ValueError(f"The given transitions of ({st},{a}) have some invalid next-states: '{invalid_next_states}'")
+        
+        if('transitions' in self.__dict__):
+            dict.__setitem__(self.transitions, (st,a), transitions)      # without the TransitionsDict dropping 'c'
+        if(c is not None):
+            arr = np.array(transitions, dtype=np.float64).reshape(-1, 3)
+            row = (np.ascontiguousarray(arr[:,0]), arr[:,1].astype(c.next_states.dtype), np.ascontiguousarray(arr[:,2]))
+            self._compiled = c.replace_rows({st*self.nActions + a : row})
+        self._samplers.pop((st,a), None)
+        self.policyCache.clear()
+        self.changedPairs.add((st,a))
     
     # Makes sure that the probabilities of transitions from each (st,a) pair, add up to 1.
     # To set equal probabilities for all transitions, set every p=0 before calling this method.
@@ -143,19 +231,124 @@ class MDP:
                 if(T==0):
                     self.transitions[st,a] = [(1/len(probs),s,r) for (p,s,r) in probs]
                 self.transitions[st,a] = [(p/T,s,r) for (p,s,r) in probs]
+                if(self.transitions[st,a] != probs):
+                    self.changedPairs.add((st,a))
+        self._invalidate()
+    
+    
+    # Drop every cached array built from the model, after it has been modified
+    def _invalidate(self) -> None:
+        self._materialize()
+        self._compiled = None
+        self._staleCompiled = None
+        self._samplers = {}
+        self.policyCache.clear()
+    
+    # Called by self.transitions (a TransitionsDict) after the transitions of the pair 'key' were set or deleted in it
+    # The compiled model is dropped, but kept aside till the next one is built, so that a later
+    #   ... self.setTransitions(self.transitions) can still find the pairs whose lists were mutated in place
+    def _pairChanged(self, key) -> None:
+        c = self.__dict__.get('_compiled')
+        c = self.__dict__.get('_staleCompiled') if (c is None) else c
+        self._invalidate()
+        self._staleCompiled = c
+        self.changedPairs.add(key)
+        
+    # Build whichever of self.state_action_pairs and self.transitions are missing, from the compiled model
+    def _materialize(self) -> None:
+        c = self.__dict__.get('_compiled')
+        if(c is None):
+            return
+        if('state_action_pairs' not in self.__dict__):
+            self.state_action_pairs = {st : set(np.flatnonzero(c.valid[st]).tolist())   for st in range(self.nStates)}
+        if('transitions' not in self.__dict__):
+            probs, nextStates, rewards = c.probs.tolist(), c.next_states.tolist(), c.rewards.tolist()
+            indptr = c.indptr.tolist()
+            rows = {(k//self.nActions, k%self.nActions) : list(zip(probs[k0:k1], nextStates[k0:k1], rewards[k0:k1]))
+                        for k,(k0,k1) in enumerate(zip(indptr[:-1], indptr[1:])) if c.valid.flat[k]}
+            self.transitions = TransitionsDict(rows, self)
+            
+    # Make an MDP from its compiled model, without building its dicts (see self._materialize)
+    @staticmethod
+    def _from_compiled(states: list, actions: list, compiled):
+        mdp = MDP(states=states, actions=actions)
+        del mdp.state_action_pairs, mdp.transitions
+        mdp._compiled = compiled
+        return mdp
+    
+    # Make an MDP directly from arrays with one element per transition, (st,a) -> (p,s,r)
+    #   'states', 'actions'     :  a list of labels or a count, as in MDP.__init__
+    #   'st', 'a'               :  int arrays of the state-action pair of each transition
+    #   'p', 's', 'r'           :  arrays of the prob, next-state and reward of each transition
+    #   'state_action_pairs'    :  None to allow exactly the pairs that have transitions, 'all', 
+    #                              ... or a bool array of shape (nStates, nActions), see CompiledMDP.valid
+    #   'tol'                   :  the probs of every pair must add up to 1 within 'tol' (set tol=None to skip this check)
+    # The checks of setStateActionPairs / setTransitions are done on the whole arrays at once,
+    #   ... and the compiled model is built directly, with the dicts only built when first needed
+    @staticmethod
+    def from_arrays(states, actions, st, a, p, s, r, state_action_pairs=None, tol=1e-6):
+        labels = MDP(states=states, actions=actions)
+        nStates, nActions = labels.nStates, labels.nActions
+        
+        st, a, p, s, r = check_transition_arrays(nStates, nActions, st, a, p, s, r)
+        
+        k = st*nActions + a
+        if(state_action_pairs is None):
+            valid = None
+        elif(isinstance(state_action_pairs, str) and state_action_pairs == 'all'):
+            valid = np.ones((nStates, nActions), dtype=bool)
+        else:
+            valid = np.asarray(state_action_pairs, dtype=bool)
+            if(valid.shape != (nStates, nActions)):
+                raise ValueError(f"Expected state_action_pairs of shape {(nStates, nActions)}, got {valid.shape}")
+        counts, valid = check_pair_counts(k, p, valid, nStates, nActions, tol)
+        
+        order = np.argsort(k, kind='stable')
+        indptr = np.zeros(nStates*nActions+1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        idx_type = np.int32 if (nStates < 2**31) else np.int64
+        c = CompiledMDP(nStates=nStates, nActions=nActions, indptr=indptr, probs=p[order], 
+                            next_states=s[order].astype(idx_type), rewards=r[order], valid=valid)
+        return MDP._from_compiled(labels.states, labels.actions, c)
+        
+    # Get the array-backed (CSR-style) form of this MDP's transition model, see CompiledMDP
+    # The result is cached, and rebuilt only after a call to setTransitions / setStateActionPairs / normalizeTransitionProbs
+    def compile(self):
+        if(self._compiled is None):
+            self._compiled = CompiledMDP.from_mdp(self)
+            self._staleCompiled = None
+        return self._compiled
+    
+    # A hash of the model, see CompiledMDP.fingerprint()
+    def fingerprint(self) -> str:
+        return self.compile().fingerprint()
                 
                 
     # get the next_state and reward, based on transition-probs for the given state-action pair and a random value 'x' in [0,1) 
+    # The cumulative probs of each state-action pair are computed on first use and cached, so that each call is a binary search
+    # The result for a given 'x' is the same as that of a linear scan over the transitions, adding up their probs
     def next_state_and_reward(self, state, action, x: float) -> tuple[int,float]:
-        probs = self.transitions[state,action]
-        tot = 0.
-        for (p,s,r) in probs:
-            tot += p
-            if(tot > x):
-                return s,r
-        else:
+        sampler = self._samplers.get((state,action))
+        if(sampler is None):
+            if('transitions' in self.__dict__):
+                probs = self.transitions[state,action]
+            else:           # don't build all the dicts just to sample
+                c = self._compiled
+                k = state*self.nActions + action
+                if(not c.valid[state,action]):
+                    raise KeyError((state,action))
+                k0, k1 = c.indptr[k], c.indptr[k+1]
+                probs = list(zip(c.probs[k0:k1].tolist(), c.next_states[k0:k1].tolist(), c.rewards[k0:k1].tolist()))
+            sampler = self._samplers[state,action] = (list(accumulate(p for (p,s,r) in probs)), probs)
+        cumprobs, probs = sampler
+        
+        i = bisect_right(cumprobs, x)
+        if(i == len(cumprobs)):
+            tot = cumprobs[-1] if len(cumprobs) else 0.
             msg = f"Value '{x}' wasn't reached on adding probs[{state},{action}]: {probs}, total={tot}"
             raise RuntimeError(msg)
+        p,s,r = probs[i]
+        return s,r
         
     def copy(self):
         states = self.states.copy()
@@ -204,18 +397,123 @@ class MDP:
     
     
     # Save this object to a file 'filename'
-    def save(self, filename : str) -> None:
+    # With binary=True, the compiled model is saved in a binary format that MDP.load() can memory-map, see _save_binary()
+    # binary=None picks the binary format for filenames ending in BINARY_EXTENSION
+    def save(self, filename : str, binary=None) -> None:
+        if(binary is None):
+            binary = str(filename).endswith(BINARY_EXTENSION)
+        if(binary):
+            self._save_binary(filename)
+            return
         with open(filename, "w") as outfile:
             outfile.write(self.serialize())
         
+    # Load an MDP saved by MDP.save(), in either format
+    # A binary file is opened with memory-mapping (unless mmap=False), with its dicts only built when first needed
     @staticmethod
-    def load(filename : str):
+    def load(filename : str, mmap=True):
+        with open(filename, "rb") as infile:
+            isBinary = (infile.read(len(BINARY_MAGIC)) == BINARY_MAGIC)
+        if(isBinary):
+            return MDP._load_binary(filename, mmap=mmap)
         with open(filename, "r") as infile:
             msg = infile.read()
         return MDP.deserialize(msg)
+    
+    
+    # The binary format is:
+    #       BINARY_MAGIC, 
+    #       the length of the header as a little-endian uint64,
+    #       the header, as json: {version_no, states, actions, arrays: {name: {dtype, shape, offset}}}
+    #       the arrays of the compiled model (see CompiledMDP), each starting at its offset, aligned to BINARY_ALIGN bytes
+    def _save_binary(self, filename : str) -> None:
+        c = self.compile()
+        arrays = {'indptr': c.indptr, 'probs': c.probs, 'next_states': c.next_states,
+                  'rewards': c.rewards, 'valid': c.valid}
+        header = {'version_no' : BINARY_VERSION, 
+                  'states'     : self.states,
+                  'actions'    : self.actions,
+                  'arrays'     : {}}
+        
+        # the offsets depend on the header's length, so fix its length with placeholder offsets first
+        for name,arr in arrays.items():
+            header['arrays'][name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': 0}
+        headerLen = len(json.dumps(header).encode()) + 32*len(arrays)      # room for the real offsets
+        offset = _align(len(BINARY_MAGIC) + 8 + headerLen)
+        for name,arr in arrays.items():
+            header['arrays'][name]['offset'] = offset
+            offset = _align(offset + arr.nbytes)
+        headerBytes = json.dumps(header).encode().ljust(headerLen)
         
+        # write a temporary file next to 'filename' and move it over, so that a model memory-mapped from 'filename'
+        #   ... (see MDP.load) keeps reading the old file, and a failed save leaves the old file as it was
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmpName = tempfile.mkstemp(dir=directory, prefix=".mdpb-")
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                outfile.write(BINARY_MAGIC)
+                outfile.write(struct.pack("<Q", headerLen))
+                outfile.write(headerBytes)
+                for name,arr in arrays.items():
+                    outfile.seek(header['arrays'][name]['offset'])
+                    outfile.write(np.ascontiguousarray(arr).tobytes())
+                outfile.truncate(offset)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmpName, filename)
+        except BaseException:
+            if(os.path.exists(tmpName)):
+                os.remove(tmpName)
+            raise
+            
+    @staticmethod
+    def _load_binary(filename : str, mmap=True):
+        with open(filename, "rb") as infile:
+            infile.read(len(BINARY_MAGIC))
+            (headerLen,) = struct.unpack("<Q", infile.read(8))
+            header = json.loads(infile.read(headerLen))
+        if(header['version_no'] != BINARY_VERSION):
+            raise ValueError(f"Encoding mismatch while trying to load '{filename}'. " + \
+                                 f"Expected version '{BINARY_VERSION}', got version '{header['version_no']}'")
+        
+        arrays = {}
+        for name,info in header['arrays'].items():
+            dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+            if(mmap and np.prod(shape) > 0):
+                arrays[name] = np.memmap(filename, dtype=dtype, mode='r', offset=info['offset'], shape=shape)
+            else:
+                arrays[name] = np.fromfile(filename, dtype=dtype, count=int(np.prod(shape)), offset=info['offset']).reshape(shape)
+                
+        states, actions = header['states'], header['actions']
+        nStates, nActions = len(states), len(actions)
+        if(arrays['valid'].shape != (nStates, nActions) or len(arrays['indptr']) != nStates*nActions+1 \
+               or arrays['indptr'][-1] != len(arrays['probs'])):
+            raise ValueError(f"The arrays in '{filename}' don't match its {nStates} states and {nActions} actions")
+        
+        c = CompiledMDP(nStates=nStates, nActions=nActions, **arrays)
+        return MDP._from_compiled(states, actions, c)
+        
+    
+    # Get the MarkovChain followed by this MDP under the given policy (a dict that maps each state to an action)
+    # With sparse=True, the chain is built directly in its sparse (CSR) form from the compiled model, see MarkovChain
+    #   ... and the policy may also be an int array of one action per state
+    # Sparse chains are kept in self.policyCache, and every call returns a fresh copy of the cached chain
+    #   ... Dense chains aren't, since copying their nStates**2 probs costs about as much as building them again
+    def getMarkovChain(self, policy, sparse=False):
+        pKey = policy_key(policy, self.nStates) if (sparse) else None
+        if(pKey is None):
+            return self._buildMarkovChain(policy, sparse)
+        key = ('chain', pKey)
+        chain = self.policyCache.get(key)
+        if(chain is None):
+            chain = self._buildMarkovChain(policy, sparse)
+            self.policyCache.put(key, chain, _chain_nbytes(chain))
+        return chain.copy()
     
-    def getMarkovChain(self, policy):
+    def _buildMarkovChain(self, policy, sparse):
+        if(sparse):
+            return self._buildSparseMarkovChain(policy)
+            
         trans_probs = []
         
         for st in range(self.nStates):
@@ -232,8 +530,463 @@ class MDP:
             trans_probs.append(tprob)
             
         return MarkovChain(states=self.states, trans_probs=trans_probs)
+    
+    # The policy is checked against the compiled model, so this never builds the dicts of a model that doesn't have them
+    def _buildSparseMarkovChain(self, policy):
+        if(isinstance(policy, np.ndarray)):
+            if(len(policy) != self.nStates):
+                raise ValueError(f"The argument policy={policy} doesn't have one entry for each of {self.nStates} states")
+            actions = policy if (policy.dtype.kind in 'iu') else policy.tolist()
+        else:
+            for st in range(self.nStates):
+                if(st not in policy.keys()):
+                    raise ValueError(f"The argument policy={policy} is missing an entry for state '{st}'")
+            actions = [policy[st] for st in range(self.nStates)]
+        
+        if(not isinstance(actions, np.ndarray)):
+            # anything that isn't an action index is invalid, same as an index that's out of range
+            actions = np.array([a if isinstance(a, (int, np.integer)) else -1 for a in actions], dtype=np.int64)
+        pi = actions.astype(np.int64, copy=False)
+        c = self.compile()
+        ok = (pi >= 0) & (pi < self.nActions)
+        ok[ok] = c.valid[np.flatnonzero(ok), pi[ok]]
+        if(not ok.all()):
+            st = int(np.argmin(ok))
+            raise ValueError(f"The given policy maps state '{st}' to an invalid action '{policy[st]}'")
+        return MarkovChain(states=self.states, trans_probs=c.policy_matrix(pi))
+
+
+
+# The dict of MDP.transitions, which tells its MDP whenever the transitions of a pair are set or deleted in it,
+#   ... so that the MDP drops its compiled model, samplers and cached results, and records the pair in MDP.changedPairs
+# Mutating the list of a pair in place (e.g. mdp.transitions[st,a].append(..)) isn't seen,
+#   ... so assign the pair again afterwards, or call MDP.setTransition(st, a) or MDP.setTransitions(mdp.transitions)
+class TransitionsDict(dict):
+    def __init__(self, transitions, mdp):
+        super().__init__(transitions)
+        self._mdp = mdp
+    
+    # copies and pickles are rebuilt in one go, rather than by setting their pairs one at a time
+    def __reduce__(self):
+        return (TransitionsDict, (dict(self), self._mdp))
+    
+    def __setitem__(self, key, value):
+        old = self.get(key)
+        super().__setitem__(key, value)
+        if(old is value or old != value):       # the same list again may have been mutated in place
+            self._changed(key)
+    
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed(key)
+    
+    def update(self, *args, **kwargs):
+        for key,value in dict(*args, **kwargs).items():
+            self[key] = value
+    
+    def setdefault(self, key, default=None):
+        if(key not in self):
+            self[key] = default
+        return self[key]
+    
+    def pop(self, key, *default):
+        if(key not in self):
+            return super().pop(key, *default)
+        value = self[key]
+        del self[key]
+        return value
+    
+    def popitem(self):
+        key, value = super().popitem()
+        self._changed(key)
+        return key, value
+    
+    def clear(self):
+        keys = list(self.keys())
+        super().clear()
+        for key in keys:
+            self._changed(key)
+    
+    def _changed(self, key) -> None:
+        self._mdp._pairChanged(key)
+
+
+# The default memory budget of MDP.policyCache, in bytes
+POLICY_CACHE_BYTES = 128 * 2**20
+
+
+# A bounded LRU cache of the results computed for a given policy (or state-values) of an MDP,
+#   ... such as its sparse MarkovChain (see MDP.getMarkovChain) and state-values (see BellmanBackup.estimate_V_pi)
+# Keys are tuples like (kind, policy_key(policy), gamma, ...), and every entry is put with its (approximate) size in bytes
+# Once the entries add up to more than 'maxBytes', the least recently used ones are evicted
+# The MDP clears its cache whenever the model is modified (see MDP._invalidate)
+class PolicyCache:
+    def __init__(self, maxBytes=None):
+        self.maxBytes = POLICY_CACHE_BYTES if (maxBytes is None) else maxBytes
+        self.nBytes = 0
+        self.hits, self.misses = 0, 0
+        self._entries = OrderedDict()       # key -> (value, nBytes), least recently used first
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, key):
+        return key in self._entries
+    
+    def __repr__(self):
+        return f"PolicyCache({len(self)} entries, {self.nBytes} of {self.maxBytes} bytes)"
+    
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if(entry is None):
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+    
+    # Keep 'value' under 'key'; a value bigger than the whole budget isn't kept
+    def put(self, key, value, nBytes: int) -> None:
+        old = self._entries.pop(key, None)
+        if(old is not None):
+            self.nBytes -= old[1]
+        if(nBytes > self.maxBytes):
+            return
+        self._entries[key] = (value, nBytes)
+        self.nBytes += nBytes
+        while(self.nBytes > self.maxBytes):
+            _, (value, size) = self._entries.popitem(last=False)
+            self.nBytes -= size
+    
+    def clear(self) -> None:
+        self._entries.clear()
+        self.nBytes = 0
+
+
+# A hashable key for a policy of an MDP with 'nStates' states (a dict s -> a, or an int array of one action per state)
+# Returns None for anything that isn't such a policy, which then doesn't get cached
+def policy_key(policy, nStates: int):
+    try:
+        if(isinstance(policy, dict)):
+            policy = [policy[st] for st in range(nStates)]
+        arr = np.asarray(policy)
+    except (KeyError, TypeError, ValueError):
+        return None
+    if(arr.shape != (nStates,) or arr.dtype.kind not in 'iu'):
+        return None
+    return _digest(arr.astype(np.int64, copy=False))
+
+
+# A hashable key for a vector of state-values (a list or array of floats)
+def values_key(V):
+    return _digest(np.asarray(V, dtype=np.float64))
+
+
+def _digest(arr: np.ndarray) -> bytes:
+    return hashlib.blake2b(np.ascontiguousarray(arr).data, digest_size=16).digest()
+
+
+# The size in bytes of a sparse MarkovChain, for PolicyCache
+def _chain_nbytes(chain: MarkovChain) -> int:
+    return sum(arr.nbytes for arr in chain.getCSR())
+
+
+# The binary file format of MDP.save()
+BINARY_MAGIC = b"MDP-BIN\0"
+BINARY_VERSION = 1
+BINARY_EXTENSION = ".mdpb"
+BINARY_ALIGN = 64
+
+# Helpers for the error messages of MDP.from_arrays, listing upto 10 of the offending values
+def _first(values, n=10) -> str:
+    values = np.asarray(values)
+    more = f" ... ({len(values)} in all)" if (len(values) > n) else ""
+    return f"{values[:n].tolist()}{more}"
+
+# upto 10 of the flagged state-action pairs, of a block of states starting at 'lo'
+def _pairs(rowMask, nActions, lo=0) -> str:
+    rows = np.flatnonzero(rowMask) + lo*nActions
+    more = f" ... ({len(rows)} in all)" if (len(rows) > 10) else ""
+    return f"{[(int(k)//nActions, int(k)%nActions) for k in rows[:10]]}{more}"
+
+def _check_indices(arr, n, what) -> None:
+    bad = (arr < 0) | (arr >= n)
+    if(bad.any()):
+        raise ValueError(f"The given Transitions data contains some invalid {what}: {_first(arr[bad])}")
+
+
+# An array of indices as int64, from ints or from floats with integral values (anything else is a ValueError)
+def _as_indices(arr, what) -> np.ndarray:
+    arr = np.asarray(arr)
+    if(arr.dtype.kind in 'iu'):
+        return arr.astype(np.int64, copy=False)
+    if(arr.dtype.kind != 'f'):
+        raise ValueError(f"The given Transitions data has {what} of type {arr.dtype}, instead of integers")
+    bad = ~np.isfinite(arr) | (arr != np.round(arr))
+    if(bad.any()):
+        raise ValueError(f"The given Transitions data contains some non-integer {what}: {_first(arr[bad])}")
+    return arr.astype(np.int64)
+
+
+# Check arrays (st, a, p, s, r) of transitions as given to MDP.from_arrays, for a model of 'nStates' states and 'nActions' actions
+# Returns them as int64 (st, a, s) and float64 (p, r) arrays
+def check_transition_arrays(nStates: int, nActions: int, st, a, p, s, r) -> tuple[np.ndarray, ...]:
+    st, a, s = _as_indices(st, "states"), _as_indices(a, "actions"), _as_indices(s, "next-states")
+    p, r = (np.asarray(arr, dtype=np.float64) for arr in (p, r))
+    if(not (len(st) == len(a) == len(p) == len(s) == len(r))):
+        raise ValueError(f"The given arrays have different lengths: {[len(st), len(a), len(p), len(s), len(r)]}")
+    
+    _check_indices(st, nStates, "states")
+    _check_indices(a, nActions, "actions")
+    _check_indices(s, nStates, "next-states")
+    if(not np.isfinite(p).all() or (p < 0).any()):
+        raise ValueError(f"The given Transitions data has some invalid probs: {_first(p[~(p >= 0) | ~np.isfinite(p)])}")
+    return st, a, p, s, r
+
+
+# Check the state-action pairs of the transitions of the states lo..lo+nStates-1, where transition 'j' is of the pair
+#   ... k[j] = (st-lo)*nActions + a, with prob p[j]
+# 'valid' is a bool (nStates, nActions) array of the possible pairs, or None to allow exactly the pairs that have transitions
+# Every possible pair needs some transitions, and no other pair may have any
+# 'tol' : the probs of every possible pair must add up to 1 within 'tol' (set tol=None to skip this check)
+# Returns (counts, valid), with the no. of transitions of every pair
+def check_pair_counts(k, p, valid, nStates: int, nActions: int, tol, lo=0) -> tuple[np.ndarray, np.ndarray]:
+    counts = np.bincount(k, minlength=nStates*nActions)
+    if(valid is None):
+        valid = (counts > 0).reshape(nStates, nActions)
+    
+    invalid = (counts > 0) & ~valid.ravel()
+    if(invalid.any()):
+        raise ValueError(f"The given Transitions data contains some invalid actions: {_pairs(invalid, nActions, lo)}")
+    missing = (counts == 0) & valid.ravel()
+    if(missing.any()):
+        raise ValueError(f"The given Transitions data did not have some state-action pairs: {_pairs(missing, nActions, lo)}")
+    if(tol is not None):
+        sums = np.bincount(k, weights=p, minlength=nStates*nActions)
+        bad = valid.ravel() & (np.abs(sums - 1) > tol)
+        if(bad.any()):
+            raise ValueError(f"The probs of some state-action pairs don't add up to 1: {_pairs(bad, nActions, lo)}")
+    return counts, valid
+
+
+# Round 'offset' up to a multiple of BINARY_ALIGN
+def _align(offset: int) -> int:
+    return -(-offset // BINARY_ALIGN) * BINARY_ALIGN
+
+
+
+class CompiledMDP:
+    # An array-backed view of the transition model of an MDP, laid out like a CSR sparse-matrix
+    # The row 'k = st*nActions + a' holds the transitions of the state-action pair (st,a), as
+    #   ... probs[k0:k1], next_states[k0:k1], rewards[k0:k1]     where k0,k1 = indptr[k],indptr[k+1]
+    # Rows of state-action pairs that aren't possible are empty
+    # valid[st,a] is True iff 'a' is a possible action in state 'st'
+    # Don't make this directly; get it from MDP.compile(), which caches it until the MDP is modified
+    
+    def __init__(self, nStates, nActions, indptr, probs, next_states, rewards, valid):
+        self.nStates = nStates
+        self.nActions = nActions
+        self.indptr = indptr              # int64 array of size nStates*nActions+1
+        self.probs = probs                # float64 array of size nnz
+        self.next_states = next_states    # int array of size nnz
+        self.rewards = rewards            # float64 array of size nnz
+        self.valid = valid                # bool array of shape (nStates, nActions)
         
+        self._rows = None
+        self._R = None
+        self._keys = None
+        self._preds = None
+        self._comps = None
+        self._fingerprint = None
         
+    def __getattr__(self, name):
+        if(name=='nnz'):
+            return len(self.probs)
         
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
         
+    def __repr__(self):
+        return f"CompiledMDP({self.nStates} states, {self.nActions} actions, {self.nnz} transitions)"
+    
+    # Pickle just the model; the arrays derived from it are rebuilt on demand, e.g. in a worker process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_rows=None, _R=None, _keys=None, _preds=None, _comps=None)
+        return state
+    
+    
+    # The row 'k = st*nActions + a' of every transition, i.e. the CSR indptr expanded to one entry per transition
+    def rows(self):
+        if(self._rows is None):
+            counts = np.diff(self.indptr)
+            self._rows = np.repeat(np.arange(self.nStates*self.nActions, dtype=self.indptr.dtype), counts)
+        return self._rows
+    
+    # The expected one-step reward R[st,a] = sum(p*r) of each state-action pair, as an (nStates, nActions) array
+    # Pairs that aren't possible get a reward of 0.
+    def expected_rewards(self):
+        if(self._R is None):
+            R = np.bincount(self.rows(), weights=self.probs*self.rewards, minlength=self.nStates*self.nActions)
+            self._R = R.reshape(self.nStates, self.nActions)
+        return self._R
+    
+    # Sort-keys to sample the transitions of many state-action pairs at once, see MDP_Iterators.simulate_batch()
+    # key[j] = k + (the cumulative prob of transition 'j' within its row 'k'), so the keys increase over the whole array
+    # Returns (keys, totals) with totals[k] the sum of probs in the row 'k'
+    # Sample row 'k' with a random value 'x' in [0,1) by np.searchsorted(keys, k + x*totals[k], side='right')
+    def sampling_keys(self):
+        if(self._keys is None):
+            cum = np.cumsum(self.probs)
+            before = np.concatenate(([0.], cum))[self.indptr]      # the cumsum upto the start of each row
+            totals = np.diff(before)
+            keys = self.rows() + (cum - np.repeat(before[:-1], np.diff(self.indptr)))
+            self._keys = (keys, totals)
+        return self._keys
+    
+    # The transition matrix P_pi of a deterministic policy, given as an int array of one action per state
+    # Returns the CSR arrays (indptr, indices, data), with P_pi[st, indices[j]] += data[j]  for j in indptr[st]:indptr[st+1]
+    def policy_matrix(self, policy: np.ndarray):
+        k = np.arange(self.nStates, dtype=np.int64)*self.nActions + policy
+        indptr, idx = csr_gather(self.indptr, k)
+        return indptr, self.next_states[idx], self.probs[idx]
+    
+    # The predecessor index of the states: the states that have some transition into each state
+    # Returns the CSR arrays (indptr, indices) such that indices[indptr[s]:indptr[s+1]] are the (distinct) predecessors of 's'
+    def predecessors(self):
+        if(self._preds is None):
+            src = self.rows() // self.nActions
+            keys = np.unique(self.next_states.astype(np.int64)*self.nStates + src)
+            indptr = np.zeros(self.nStates+1, dtype=np.int64)
+            np.cumsum(np.bincount(keys // self.nStates, minlength=self.nStates), out=indptr[1:])
+            self._preds = (indptr, keys % self.nStates)
+        return self._preds
+    
+    # The strongly connected components of the state graph, with an edge s -> s' iff some action of 's' can lead to s'
+    # Returns (nComps, labels, levels, cyclic), where
+    #       labels[s]   :  the component of state 's', numbered in reverse topological order
+    #                      ... so every transition s -> s' has labels[s] >= labels[s'], see SparseUtils
+    #       levels[c]   :  the length of the longest path from component 'c' to a component that has no way out
+    #       cyclic[c]   :  True iff 'c' has a cycle (more than one state, or a self-loop), else one backup of it is exact
+    # The result is cached, so repeated solves of the same model reuse it
+    def components(self):
+        if(self._comps is None):
+            nStates = self.nStates
+            keep = self.probs > 0
+            keys = np.unique((self.rows() // self.nActions)[keep]*nStates + self.next_states[keep])
+            indptr = np.zeros(nStates+1, dtype=np.int64)
+            np.cumsum(np.bincount(keys // nStates, minlength=nStates), out=indptr[1:])
+            nComps, labels = strongly_connected_components(indptr, keys % nStates)
+            
+            srcComp, dstComp = labels[keys // nStates], labels[keys % nStates]
+            inner = srcComp == dstComp
+            cyclic = np.bincount(labels, minlength=nComps) > 1
+            cyclic[srcComp[inner]] = True
+            
+            # edges between components only go to lower labels, so visiting them by source label finalizes levels in order
+            edges = np.unique(srcComp[~inner]*nComps + dstComp[~inner])
+            levels = [0] * nComps
+            for a, b in zip((edges // nComps).tolist(), (edges % nComps).tolist()):
+                if(levels[b] + 1 > levels[a]):
+                    levels[a] = levels[b] + 1
+            self._comps = (nComps, labels, np.array(levels, dtype=np.int64), cyclic)
+        return self._comps
+    
+    # A hash of the whole model (sizes, possible actions and transitions), as a hex string
+    # Models with the same fingerprint have the same compiled arrays, see Checkpoint
+    def fingerprint(self) -> str:
+        if(self._fingerprint is None):
+            h = hashlib.blake2b(digest_size=16)
+            h.update(struct.pack("<QQ", self.nStates, self.nActions))
+            idx_type = '<i4' if (self.nStates < 2**31) else '<i8'
+            for arr, dtype in ((self.indptr, '<i8'), (self.valid, '|b1'), (self.probs, '<f8'), 
+                               (self.next_states, idx_type), (self.rewards, '<f8')):
+                h.update(np.ascontiguousarray(arr, dtype=dtype).data)
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
     
+    # The expected one-step reward of each state, under a deterministic policy (an int array of one action per state)
+    def policy_rewards(self, policy: np.ndarray) -> np.ndarray:
+        return self.expected_rewards()[np.arange(self.nStates), policy]
+    
+    # A copy of this model with the transitions of some (possible) state-action pairs replaced
+    # 'rows' maps the row 'k = st*nActions + a' to the arrays (probs, next_states, rewards) of its new transitions
+    # The expected rewards and the predecessor index are patched in just the changed rows, if they were built already
+    def replace_rows(self, rows: dict):
+        ks = sorted(rows)
+        counts = np.diff(self.indptr)
+        counts[ks] = [len(rows[k][0]) for k in ks]
+        indptr = np.zeros_like(self.indptr)
+        np.cumsum(counts, out=indptr[1:])
+        
+        # the unchanged runs of transitions between the replaced rows, interleaved with the new rows
+        pieces = ([], [], [])
+        prev = 0
+        for k in ks:
+            for piece, old, new in zip(pieces, (self.probs, self.next_states, self.rewards), rows[k]):
+                piece.append(old[prev:self.indptr[k]])
+                piece.append(np.asarray(new, dtype=old.dtype))
+            prev = self.indptr[k+1]
+        for piece, old in zip(pieces, (self.probs, self.next_states, self.rewards)):
+            piece.append(old[prev:])
+        new = CompiledMDP(self.nStates, self.nActions, indptr, *(np.concatenate(piece) for piece in pieces), self.valid)
+        
+        if(self._R is not None):
+            R = self._R.copy()
+            for k in ks:
+                probs, nextStates, rewards = rows[k]
+                R.flat[k] = np.dot(probs, rewards)
+            new._R = R
+        if(self._preds is not None):
+            new._preds = self._patch_predecessors(new, np.unique(np.array(ks, dtype=np.int64) // self.nActions))
+        return new
+    
+    # The predecessor index of 'new', which differs from this model only in the transitions of the states 'changed'
+    def _patch_predecessors(self, new, changed: np.ndarray):
+        def successors(c, st):
+            return set(c.next_states[c.indptr[st*c.nActions] : c.indptr[(st+1)*c.nActions]].tolist())
+        removed, added = [], []
+        for st in changed.tolist():
+            before, after = successors(self, st), successors(new, st)
+            removed.extend(t*self.nStates + st for t in before - after)
+            added.extend(t*self.nStates + st for t in after - before)
+        
+        # the keys target*nStates + source of the old index are sorted, so edges are deleted and inserted in place
+        indptr, indices = self._preds
+        keys = csr_row_ids(indptr)*self.nStates + indices
+        keys = np.delete(keys, np.searchsorted(keys, np.array(removed, dtype=np.int64)))
+        added = np.sort(np.array(added, dtype=np.int64))
+        keys = np.insert(keys, np.searchsorted(keys, added), added)
+        
+        indptr = np.zeros(self.nStates+1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // self.nStates, minlength=self.nStates), out=indptr[1:])
+        return indptr, keys % self.nStates
+    
+    
+    # Build the arrays from the dict-based model of 'mdp'
+    @staticmethod
+    def from_mdp(mdp: MDP):
+        if(mdp.state_action_pairs is None or mdp.transitions is None):
+            raise ValueError(f"Can't compile {mdp!r} before its state-action pairs and transitions are set")
+            
+        nStates, nActions = mdp.nStates, mdp.nActions
+        
+        valid = np.zeros((nStates, nActions), dtype=bool)
+        for st in range(nStates):
+            valid[st, list(mdp.state_action_pairs[st])] = True
+            
+        counts = np.zeros(nStates*nActions + 1, dtype=np.int64)
+        triplets = []
+        for k in np.flatnonzero(valid).tolist():      # row-major order, so the rows come out sorted
+            trans = mdp.transitions[k//nActions, k%nActions]
+            counts[k+1] = len(trans)
+            triplets.extend(trans)
+        indptr = np.cumsum(counts)
+        
+        arr = np.array(triplets, dtype=np.float64).reshape(-1, 3)
+        idx_type = np.int32 if (nStates < 2**31) else np.int64
+        return CompiledMDP(nStates=nStates, nActions=nActions, indptr=indptr,
+                               probs=np.ascontiguousarray(arr[:,0]), 
+                               next_states=arr[:,1].astype(idx_type),
+                               rewards=np.ascontiguousarray(arr[:,2]), 
+                               valid=valid)
+
@@ -1,7 +1,10 @@
 
 import random
 
-from MDP import MDP
+import numpy as np
+
+from MDP import MDP, CompiledMDP
+from BellmanBackup import policy_to_array
 
 class MDP_Iterator:
     def __init__(self, mdp: MDP, start=None, gamma=1, rng=None, maxIter=1_000):
@@ -14,6 +17,8 @@ class MDP_Iterator:
         
         self.iterCnt = 0       # no. of steps taken till now
         
+        self.maxIter = int(maxIter)
+        
         if((type(rng) is int) or (type(rng) is float)):     # preset seed-value
             self.rng = random.Random(rng)
         elif(rng is None):                                  # random seed-value
@@ -22,7 +27,7 @@ class MDP_Iterator:
             raise ValueError(f"Argument '{rng}' is not a valid RNG or seed-value in {type(self).__name__} con'r")
        
         if(start is None):
-            self.state = self.rng.randint(0, self.chain.nStates-1)
+            self.state = self.rng.randint(0, self.mdp.nStates-1)
         else:
             self.state = start
         
@@ -31,7 +36,7 @@ class MDP_Iterator:
         raise NotImplementedError("Trying to call step() on the abstract base-class iterator. Forgot to overload?")
     
     def step(self):
-        if(self.iterCnt == self.maxiter):
+        if(self.iterCnt == self.maxIter):
             raise StopIteration()    
         
         action = self._select_action()
@@ -53,7 +58,7 @@ class MDP_Iterator:
 # selects an action at random, using the self.rng
 class Random_MDP_Iterator(MDP_Iterator):
     def _select_action(self):
-        self.rng.choice(self.mdp.possibleActions(self.state))
+        return self.rng.choice(list(self.mdp.possibleActions(self.state)))
 
 
         
@@ -119,16 +124,62 @@ class Policy_MDP_Iterator(MDP_Iterator):
             raise ValueError(f"The given policy has some invalid actions {invalid_actions}")
         
         self.policy = policy
-            
-
-    
-
-
-        
 
 
 
-
-
-
-        
\ No newline at end of file
+# Simulate many runs of the MDP at once, in lock-step on NumPy arrays
+# Runs 'n_episodes' episodes of 'horizon' steps each, selecting actions the same way as the iterators above:
+#       policy = a dict (or int array) of one action per state  :  as in Policy_MDP_Iterator
+#       policy = None                                           :  a uniformly random possible action, as in Random_MDP_Iterator
+# 'start' is the start-state of every episode (an int) or of each episode (an array); None picks uniformly random ones
+# 'seed' is the seed-value (or np.random.Generator) of the RNG
+# 'batch_size' bounds the number of episodes held in memory at a time
+# 'mdp' may also be a CompiledMDP, e.g. to ship just the arrays of the model to another process
+# Returns an array of the discounted returns sum(gamma**t * r_t) of the episodes, same as MDP_Iterator.tot_reward
+def simulate_batch(mdp: MDP, policy=None, n_episodes=1_000, horizon=1_000, gamma=1, seed=None, start=None,
+                       batch_size=100_000) -> np.ndarray:
+    c = mdp if isinstance(mdp, CompiledMDP) else mdp.compile()
+    rng = np.random.default_rng(seed)
+    keys, totals = c.sampling_keys()
+    
+    if(policy is None):
+        nValid = c.valid.sum(axis=1)
+        if((nValid == 0).any()):
+            raise ValueError(f"Some states have no possible actions: {np.flatnonzero(nValid == 0).tolist()}")
+        actPtr = np.concatenate(([0], np.cumsum(nValid)))
+        actList = np.nonzero(c.valid)[1]            # the possible actions of each state, in order
+    else:
+        pi = policy_to_array(policy, c.nStates)
+        if(len(pi) != c.nStates or not c.valid[np.arange(c.nStates), pi].all()):
+            raise ValueError("The given policy has some missing states or invalid actions")
+    
+    if(start is not None):
+        start = np.broadcast_to(np.asarray(start, dtype=np.int64), (n_episodes,))
+        if(start.min(initial=0) < 0 or start.max(initial=0) >= c.nStates):
+            raise ValueError(f"Argument start={start} has some invalid states")
+        
+    returns = np.empty(n_episodes)
+    for b0 in range(0, n_episodes, batch_size):
+        n = min(batch_size, n_episodes - b0)
+        if(start is None):
+            states = rng.integers(0, c.nStates, size=n)
+        else:
+            states = start[b0:b0+n].copy()
+        
+        G = np.zeros(n)
+        discount = 1.
+        for t in range(horizon):
+            if(policy is None):
+                j = (rng.random(n) * nValid[states]).astype(np.int64)
+                actions = actList[actPtr[states] + np.minimum(j, nValid[states]-1)]
+            else:
+                actions = pi[states]
+            k = states*c.nActions + actions
+            idx = np.searchsorted(keys, k + rng.random(n)*totals[k], side='right')
+            idx = np.clip(idx, c.indptr[k], c.indptr[k+1]-1)
+            G += discount * c.rewards[idx]
+            states = c.next_states[idx]
+            discount *= gamma
+        returns[b0:b0+n] = G
+        
+    return returns
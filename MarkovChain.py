@@ -1,5 +1,11 @@
 
 import random
+from bisect import bisect_right
+from itertools import accumulate
+
+import numpy as np
+
+from SparseUtils import csr_row_ids, csr_rmatvec, csr_submatrix, csr_sum_duplicates, strongly_connected_components, gmres
 
 class MarkovChain:
     def __init__(self, states, trans_probs='equal'):
@@ -7,6 +13,12 @@ class MarkovChain:
         # tprob is a list of lists; tprob[i][j] being the probability to transition to 'j' from 'i'
         # there are no disallowed states from any given state, although you can set Prob[S(i) -> S(j)]=0
         # The markov chain doesn't store state
+        # For a sparse chain, pass trans_probs as a tuple of CSR arrays (indptr, indices, data) instead, see SparseUtils
+        #   ... then self.sparse is True, and self.tprob is None; the probs are only kept in self.getCSR()
+        
+        self._samplers = {}     # cached st -> (cumulative probs, next-states), see self.next_state_from()
+        self._csr = None        # (cached) CSR arrays of tprob, see self.getCSR()
+        self.sparse = False
         
         if(type(states)==int):
             self.states = [f"State-{i}" for i in range(states)]
@@ -19,6 +31,8 @@ class MarkovChain:
             self.tprob = [[1/len(self.states) for j in range(len(self.states))] for i in range(len(self.states))]
         elif(type(trans_probs) == list):
             self.tprob = trans_probs
+        elif(type(trans_probs) == tuple and len(trans_probs) == 3):
+            self.setSparseProbs(*trans_probs)
         else:
             raise TypeError(f"Unknown value for arg 'trans_probs': {trans_probs} in call to MarkovChain.__init__()")
         
@@ -46,30 +60,97 @@ class MarkovChain:
         return MarkovChainIterator(self, skipInitial=True)
     
     
+    # set the transition probs of a sparse chain from CSR arrays, with the same layout as self.getCSR()
+    # The entries of each row get sorted by column, and duplicates summed up
+    def setSparseProbs(self, indptr, indices, data):
+        indptr, indices, data = np.asarray(indptr), np.asarray(indices), np.asarray(data, dtype=np.float64)
+        if(len(indptr) != self.nStates+1):
+            raise ValueError(f"Expected an indptr of {self.nStates+1} elements, got {len(indptr)} in call to setSparseProbs()")
+        if(len(indices) and (indices.min() < 0 or indices.max() >= self.nStates)):
+            raise ValueError("The given sparse transition probs have some invalid next-states")
+        self.sparse = True
+        self.tprob = None
+        self._csr = csr_sum_duplicates(indptr, indices, data, self.nStates)
+        self._samplers = {}
+    
+    
     def normalizeTransitionProbs(self):
+        if(self.sparse):
+            self._normalizeSparse()
+            return
         for st in range(self.nStates):
             T = sum(self.tprob[st])
             if(T==0):                   # when all probabilities are set to '0'
                 self.tprob[st] = [(1/self.nStates) for i in range(self.nStates)]
             self.tprob[st] = [p/T for p in self.tprob[st]]
+        self._invalidate()
+        
+    # For a sparse chain, a row whose probs are all '0' gets equal probs over its stored entries (not over all states)
+    def _normalizeSparse(self):
+        indptr, indices, data = self._csr
+        counts = np.diff(indptr)
+        if((counts == 0).any()):
+            raise ValueError(f"Can't normalize the empty rows of states: {np.flatnonzero(counts == 0).tolist()}")
+        rows = csr_row_ids(indptr)
+        T = np.bincount(rows, weights=data, minlength=self.nStates)
+        data = np.where((T == 0)[rows], 1., data)
+        T = np.where(T == 0, counts, T)
+        self._csr = (indptr, indices, data / T[rows])
+        self._invalidate()
+        
+    # Drop the cached samplers and arrays, after self.tprob has been modified
+    def _invalidate(self):
+        self._samplers = {}
+        if(not self.sparse):
+            self._csr = None
+        
+    # The non-zero entries of tprob, as the CSR arrays (indptr, indices, data), see SparseUtils
+    # For a sparse chain, these are its transition probs
+    def getCSR(self):
+        if(self._csr is None):
+            P = np.asarray(self.tprob, dtype=np.float64).reshape(self.nStates, self.nStates)
+            rows, cols = np.nonzero(P)
+            indptr = np.zeros(self.nStates+1, dtype=np.int64)
+            np.cumsum(np.bincount(rows, minlength=self.nStates), out=indptr[1:])
+            self._csr = (indptr, cols, P[rows, cols])
+        return self._csr
 
 
     # calculate the next state of this markov chain, based on a random value 'x' in [0,1)        
+    # Only the non-zero probs of each state are kept, as cumulative probs made on first use, and searched with bisection
+    # The result for a given 'x' is the same as that of a linear scan over tprob[st], adding up its probs
     def next_state_from(self, st: int, x: float) -> int:
         # 'x' must be a value b/w 0 and 1, generated using rng.random()
-        tot = 0.
-        for newSt in range(self.nStates):
-            tot += self.tprob[st][newSt]
-            if(tot > x):
-                return newSt
-        else:
-            msg = f"Value '{x}' wasn't reached on adding probs: {self.tprob[st]}, total={tot}"
+        sampler = self._samplers.get(st)
+        if(sampler is None):
+            sampler = self._samplers[st] = self._make_sampler(st)
+        cumprobs, nextStates = sampler
+        
+        i = bisect_right(cumprobs, x)
+        if(i == len(cumprobs)):
+            tot = cumprobs[-1] if len(cumprobs) else 0.
+            probs = self.tprob[st] if (not self.sparse) else dict(zip(nextStates, np.diff(cumprobs, prepend=0.).tolist()))
+            msg = f"Value '{x}' wasn't reached on adding probs: {probs}, total={tot}"
             raise RuntimeError(msg)
+        return nextStates[i]
+    
+    def _make_sampler(self, st):
+        if(self.sparse):
+            indptr, indices, data = self._csr
+            a, b = indptr[st], indptr[st+1]
+            keep = data[a:b] != 0
+            probs, nextStates = data[a:b][keep].tolist(), indices[a:b][keep].tolist()
+        else:
+            nextStates = [newSt for newSt,p in enumerate(self.tprob[st]) if p != 0]
+            probs = [self.tprob[st][newSt] for newSt in nextStates]
+        return list(accumulate(probs)), nextStates
  
     
     # make a copy of this MarkovChain object
     def copy(self):
         states = self.states.copy()
+        if(self.sparse):
+            return MarkovChain(states=states, trans_probs=tuple(arr.copy() for arr in self._csr))
         tprob = [self.tprob[st].copy() for st in range(self.nStates)]
         return MarkovChain(states=states, trans_probs=tprob)
     
@@ -140,8 +221,190 @@ def estimate_steady_dist(mchain: MarkovChain, start=None, nIter=100_000, rng=Non
 
 
 
+
+######################################
+#  EXACT STEADY-STATE DISTRIBUTIONS
+######################################
+
+
+class CommunicatingClass:
+    # A communicating class of a MarkovChain: a maximal set of states that can all reach each other
+    # 'states'   :  an int array of the states in this class
+    # 'closed'   :  True iff no state outside the class can be reached from it, i.e. its states are recurrent
+    # 'period'   :  the gcd of the lengths of all cycles in the class, with 1 for an aperiodic class
+    #               ... only computed for closed classes, and None for the others
+    
+    def __init__(self, states, closed, period):
+        self.states = states
+        self.closed = closed
+        self.period = period
+        
+    def __repr__(self):
+        kind = f"closed, period {self.period}" if (self.closed) else "transient"
+        return f"CommunicatingClass({len(self.states)} states, {kind})"
+
+
+# Split the states of the given markov chain into its communicating classes
+# Returns a list of CommunicatingClass, in reverse topological order:
+#   ... a class can only reach itself and the classes before it in the list
+def communicating_classes(mchain: MarkovChain) -> list[CommunicatingClass]:
+    indptr, indices, data = _positive_entries(*mchain.getCSR())
+    nComps, labels = strongly_connected_components(indptr, indices)
+    
+    rows = csr_row_ids(indptr)
+    leaving = labels[rows] != labels[indices]
+    closed = np.ones(nComps, dtype=bool)
+    closed[labels[rows[leaving]]] = False
+    
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(nComps+1))
+    periods = _periods(indptr, indices, labels, closed, order, bounds)
+    
+    return [CommunicatingClass(order[bounds[c]:bounds[c+1]], bool(closed[c]), (int(periods[c]) if closed[c] else None))
+                for c in range(nComps)]
+
+
+# The exact steady-state distribution of the given markov chain, as an nStates-array
+# The chain must have a single closed class (transient states get probability 0); 
+#   ... use steady_dist_per_class() for chains with more than one
+# 'method' picks the solver used on the closed class:
+#       'solve'     :  a dense linear solve of pi (P - I) = 0, with sum(pi) = 1
+#       'sparse'    :  GMRES on the same system, with the sparse (CSR) transition probs
+#       'power'     :  power iteration pi <- pi P, till successive iterates differ by less than 'tol' (in l1 norm)
+#                      ... periodic classes are solved on the lazy chain (P + I)/2, which has the same steady-state
+#       'auto'      :  'solve' for classes upto DENSE_SOLVE_MAX_STATES states, else 'sparse'
+def steady_dist(mchain: MarkovChain, method='auto', tol=1e-12, maxIter=100_000) -> np.ndarray:
+    results = steady_dist_per_class(mchain, method=method, tol=tol, maxIter=maxIter)
+    if(len(results) > 1):
+        raise ValueError(f"{mchain!r} has {len(results)} closed communicating classes, so its steady-state distribution"
+                             " isn't unique. Use steady_dist_per_class() instead")
+    return results[0][1]
+
+# The largest closed class for which steady_dist(method='auto') does a dense solve
+DENSE_SOLVE_MAX_STATES = 2_000
+
+
+# The steady-state distribution of each closed class of the given markov chain
+# Returns a list of tuples (cls, dist), one per closed CommunicatingClass 'cls', 
+#   ... where 'dist' is an nStates-array that's 0 outside of cls.states
+# See steady_dist() for the arguments
+def steady_dist_per_class(mchain: MarkovChain, method='auto', tol=1e-12, maxIter=100_000) -> list[tuple]:
+    if(method not in ('auto', 'solve', 'sparse', 'power')):
+        raise ValueError(f"Unknown value for arg 'method': {method} in call to steady_dist_per_class()")
+    indptr, indices, data = _positive_entries(*mchain.getCSR())
+    
+    results = []
+    for cls in communicating_classes(mchain):
+        if(not cls.closed):
+            continue
+        sub = csr_submatrix(indptr, indices, data, cls.states)
+        m = method
+        if(m == 'auto'):
+            m = 'solve' if (len(cls.states) <= DENSE_SOLVE_MAX_STATES) else 'sparse'
+        if(m == 'solve'):
+            x = _stationary_dense(*sub)
+        elif(m == 'sparse'):
+            x = _stationary_sparse(*sub, tol=tol, maxIter=maxIter)
+        else:
+            x = _stationary_power(*sub, lazy=(cls.period != 1), tol=tol, maxIter=maxIter)
+        dist = np.zeros(mchain.nStates)
+        dist[cls.states] = x / x.sum()
+        results.append((cls, dist))
+        
+    return results
+
+
+# Drop the zero entries of a CSR matrix
+def _positive_entries(indptr, indices, data):
+    keep = data > 0
+    if(keep.all()):
+        return indptr, indices, data
+    rows = csr_row_ids(indptr)[keep]
+    ptr = np.zeros(len(indptr), dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(indptr)-1), out=ptr[1:])
+    return ptr, indices[keep], data[keep]
+
+
+# The period of each closed component, from the BFS-levels of its states (starting at one state per component)
+# The period is the gcd of (level[i] + 1 - level[j]) over all the edges i -> j within the component
+def _periods(indptr, indices, labels, closed, order, bounds) -> np.ndarray:
+    n = len(indptr) - 1
+    rows = csr_row_ids(indptr)
+    inner = (labels[rows] == labels[indices]) & closed[labels[rows]]
+    src, dst = rows[inner], indices[inner]
+    ptr = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=ptr[1:])
+    
+    level = np.full(n, -1, dtype=np.int64)
+    frontier = order[bounds[:-1][closed]]           # one root state per closed component
+    depth = 0
+    while(len(frontier)):
+        level[frontier] = depth
+        lengths = ptr[frontier+1] - ptr[frontier]
+        nbrs = dst[np.arange(lengths.sum()) + np.repeat(ptr[frontier] - np.cumsum(lengths) + lengths, lengths)]
+        frontier = np.unique(nbrs[level[nbrs] == -1])
+        depth += 1
+    
+    periods = np.zeros(len(closed), dtype=np.int64)
+    if(len(src)):
+        cls = labels[src]
+        byClass = np.argsort(cls, kind='stable')
+        starts = np.flatnonzero(np.diff(cls[byClass], prepend=-1))
+        gaps = np.abs(level[src] + 1 - level[dst])[byClass]
+        periods[cls[byClass][starts]] = np.gcd.reduceat(gaps, starts)
+    return periods
+
+
+# Solve pi P = pi with sum(pi) = 1, replacing one equation of (P^T - I) pi = 0 by the normalization
+def _stationary_dense(indptr, indices, data) -> np.ndarray:
+    m = len(indptr) - 1
+    A = np.zeros((m, m))
+    np.add.at(A, (indices, csr_row_ids(indptr)), data)      # A = P^T
+    A -= np.eye(m)
+    A[-1] = 1.
+    b = np.zeros(m)
+    b[-1] = 1.
+    return np.linalg.solve(A, b)
+
+
+# Solve pi P = pi by fixing pi[0] = 1, which leaves the non-singular system
+#   ... pi[j] - sum_{i>0} pi[i] P[i,j] = P[0,j]      for j > 0
+def _stationary_sparse(indptr, indices, data, tol, maxIter) -> np.ndarray:
+    m = len(indptr) - 1
+    if(m == 1):
+        return np.ones(1)
+    rows = csr_row_ids(indptr)
+    
+    def matvec(y):
+        x = np.concatenate(([0.], y))
+        return y - csr_rmatvec(indptr, indices, data, x, m, rows=rows)[1:]
+    
+    e0 = np.zeros(m)
+    e0[0] = 1.
+    b = csr_rmatvec(indptr, indices, data, e0, m, rows=rows)[1:]
+    y, _ = gmres(matvec, b, atol=tol, maxIter=maxIter)
+    return np.concatenate(([1.], y))
+
+
+# Iterate pi <- pi P from the uniform distribution, or pi <- (pi + pi P)/2 on the lazy chain
+def _stationary_power(indptr, indices, data, lazy, tol, maxIter) -> np.ndarray:
+    m = len(indptr) - 1
+    rows = csr_row_ids(indptr)
+    x = np.full(m, 1/m)
+    for i in range(maxIter):
+        xx = csr_rmatvec(indptr, indices, data, x, m, rows=rows)
+        if(lazy):
+            xx = (x + xx) / 2
+        xx /= xx.sum()
+        diff = np.abs(xx - x).sum()
+        x = xx
+        if(diff < tol):
+            break
+    return x
+
+
+
 # if __name__=='__main__':
 #     m = MarkovChain(5, 'equal')
 #     #res = estimate_steady_dist(m, nIter=1_000_000, counts_to_prob=True)
 #     #print(res)
-    
\ No newline at end of file
@@ -0,0 +1,146 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+
+import numpy as np
+
+from MDP import MDP
+from MarkovChain import MarkovChain, estimate_steady_dist
+from MDP_Iterators import simulate_batch
+
+# Monte Carlo estimates, sharded over a pool of worker processes
+# The work is split into 'nShards' shards (default: one per worker), each with its own seed derived from a master seed
+# Shards are merged in a fixed order, so the results are bit-identical for a given seed and number of shards,
+#   ... whatever the number of workers that ran them
+
+
+
+class Estimate:
+    # The mean of some samples, with its standard error and a confidence interval
+    # 'n' is the number of samples, 'var' their (unbiased) variance
+    
+    def __init__(self, n, mean, var, confidence=0.95):
+        self.n = n
+        self.mean = mean
+        self.var = var
+        self.confidence = confidence
+        
+    def __getattr__(self, name):
+        if(name=='stderr'):
+            return np.sqrt(self.var / self.n)
+        elif(name=='ci'):               # the confidence interval (lo, hi) around the mean
+            z = NormalDist().inv_cdf((1 + self.confidence) / 2)
+            return (self.mean - z*self.stderr, self.mean + z*self.stderr)
+        
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        
+    def __repr__(self):
+        return f"Estimate(mean={self.mean}, stderr={self.stderr}, n={self.n})"
+
+
+
+# Independent, deterministic seed-values for 'nShards' shards, derived from the master seed
+# seed=None draws a fresh master seed from the OS
+def shard_seeds(seed, nShards: int) -> list[int]:
+    children = np.random.SeedSequence(seed).spawn(nShards)
+    return [int(child.generate_state(1, dtype=np.uint64)[0]) for child in children]
+
+
+# Split 'n' items into 'nShards' near-equal shard sizes
+def shard_sizes(n: int, nShards: int) -> list[int]:
+    return [n//nShards + (1 if (i < n%nShards) else 0) for i in range(nShards)]
+
+
+# Run fn(*args) for each tuple in 'argsList' on 'nWorkers' processes, returning the results in order
+def _run_shards(fn, argsList, nWorkers):
+    if(nWorkers == 1):
+        return [fn(*args) for args in argsList]
+    with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+        return list(pool.map(fn, *zip(*argsList)))
+
+
+def _resolve_counts(nWorkers, nShards):
+    nWorkers = os.cpu_count() if (nWorkers is None) else int(nWorkers)
+    nShards = nWorkers if (nShards is None) else int(nShards)
+    if(nWorkers < 1 or nShards < 1):
+        raise ValueError(f"Expected at least 1 worker and shard, got nWorkers={nWorkers}, nShards={nShards}")
+    return min(nWorkers, nShards), nShards
+
+
+
+#############################
+#  POLICY RETURNS
+#############################
+
+
+def _returns_shard(mdp, policy, n, horizon, gamma, seed, start):
+    R = simulate_batch(mdp, policy, n_episodes=n, horizon=horizon, gamma=gamma, seed=seed, start=start)
+    mean = R.mean() if n else 0.
+    return n, mean, ((R - mean)**2).sum()
+
+
+# Estimate the expected discounted return of 'policy' (None for random actions, see simulate_batch)
+#   ... from 'n_episodes' episodes of 'horizon' steps, sharded over 'nWorkers' processes
+# 'start' is the start-state of every episode (an int), of each episode (an array), or None for random start-states
+# Returns an Estimate of the return
+def parallel_policy_returns(mdp: MDP, policy=None, n_episodes=100_000, horizon=1_000, gamma=1, start=None,
+                                seed=None, nWorkers=None, nShards=None, confidence=0.95) -> Estimate:
+    nWorkers, nShards = _resolve_counts(nWorkers, nShards)
+    # compile once here, rather than once in every worker, and send the shards just the compiled model
+    #   ... since the MDP also pickles its dicts, samplers and policyCache
+    c = mdp.compile()
+    
+    argsList = []
+    offset = 0
+    for n, s in zip(shard_sizes(n_episodes, nShards), shard_seeds(seed, nShards)):
+        st = start[offset:offset+n] if (start is not None and np.ndim(start)) else start
+        argsList.append((c, policy, n, horizon, gamma, s, st))
+        offset += n
+        
+    # merge the (count, mean, sum of squared deviations) of the shards, in order
+    N, mean, M2 = 0, 0., 0.
+    for n, m, m2 in _run_shards(_returns_shard, argsList, nWorkers):
+        if(n == 0):
+            continue
+        delta = m - mean
+        mean += delta * n / (N + n)
+        M2 += m2 + delta**2 * N * n / (N + n)
+        N += n
+    
+    var = M2 / (N - 1) if (N > 1) else float('nan')
+    return Estimate(N, float(mean), float(var), confidence)
+
+
+
+#############################
+#  STEADY-STATE DISTRIBUTION
+#############################
+
+
+def _steady_dist_shard(mchain, start, nIter, seed):
+    cnt = estimate_steady_dist(mchain, start=start, nIter=nIter, rng=seed)
+    return np.array([cnt[i] for i in range(mchain.nStates)], dtype=np.int64)
+
+
+# Estimate the steady-state distribution of 'mchain' (see estimate_steady_dist)
+#   ... from 'nShards' independent runs of the chain, with 'nIter' steps between them all, over 'nWorkers' processes
+# Returns a list of one Estimate per state, of its probability under the steady-state distribution
+# Each Estimate's variance comes from the spread of the shards' own estimates, and needs 2 or more shards
+def parallel_steady_dist(mchain: MarkovChain, nIter=1_000_000, start=None,
+                             seed=None, nWorkers=None, nShards=None, confidence=0.95) -> list[Estimate]:
+    nWorkers, nShards = _resolve_counts(nWorkers, nShards)
+    argsList = [(mchain, start, n, s) for n, s in zip(shard_sizes(nIter, nShards), shard_seeds(seed, nShards))]
+    counts = np.array(_run_shards(_steady_dist_shard, argsList, nWorkers))      # (nShards, nStates)
+    
+    sizes = counts.sum(axis=1)
+    total = sizes.sum()
+    probs = counts.sum(axis=0) / total
+    # variance of the pooled mean, from the size-weighted spread of the shards' estimates
+    shardProbs = counts / np.maximum(sizes, 1)[:,None]
+    if(nShards > 1):
+        var_mean = (sizes[:,None]**2 * (shardProbs - probs)**2).sum(axis=0) / total**2 * nShards / (nShards - 1)
+    else:
+        var_mean = np.full(mchain.nStates, np.nan)
+    
+    # Estimate holds the per-sample variance, so scale up the variance of the mean by the no. of samples
+    return [Estimate(int(total), float(probs[i]), float(var_mean[i]*total), confidence) for i in range(mchain.nStates)]
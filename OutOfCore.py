@@ -0,0 +1,198 @@
+import os
+import json
+
+import numpy as np
+
+from MDP import MDP, check_transition_arrays, check_pair_counts
+from BellmanBackup import B_block_vec, _reporter
+
+# Value iteration for models too big for memory, even as a CompiledMDP
+# The transition model lives on disk as shards of consecutive source states (see write_shards),
+#   ... and every sweep streams the shards through memory one at a time, memory-mapped
+# Only the state-values are kept in memory, plus the arrays of the shard being swept
+#
+#       sharded = shard_mdp(MDP.load("big.mdpb"), "big-shards", dtype=np.float32)
+#       V, iterCnt = estimate_V_star_ooc(sharded, gamma=0.95)
+
+
+
+SHARD_VERSION = 1
+SHARD_MANIFEST = "manifest.json"
+
+# The records of the temporary per-block bucket files of write_shards()
+_BUCKET_RECORD = np.dtype([('k', '<i8'), ('p', '<f8'), ('s', '<i8'), ('r', '<f8')])
+
+
+class ShardedMDP:
+    # The transition model of an MDP stored as shards on disk, made by write_shards() or shard_mdp()
+    # The shard 'i' covers the states lo..hi-1 (see self.blocks), and holds the .npy arrays
+    #       'rows'         :  int32, the state-action pair (st-lo)*nActions + a of each transition, in increasing order
+    #       'probs'        :  the prob of each transition, in the storage dtype
+    #       'next_states'  :  the next-state of each transition, int32 (int64 for 2**31 states or more)
+    #       'R'            :  the expected reward of each state-action pair, a (hi-lo, nActions) array in the storage dtype
+    #       'valid'        :  a bool (hi-lo, nActions) array, True iff the action is possible in the state
+    # Only the expected rewards are kept, so the shards are enough to solve the model, but not to rebuild the MDP
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, SHARD_MANIFEST), "r") as infile:
+            manifest = json.load(infile)
+        if(manifest['version_no'] != SHARD_VERSION):
+            raise ValueError(f"Encoding mismatch while trying to open the shards in '{directory}'. "
+                             f"Expected version '{SHARD_VERSION}', got version '{manifest['version_no']}'")
+        self.nStates = manifest['nStates']
+        self.nActions = manifest['nActions']
+        self.dtype = np.dtype(manifest['dtype'])
+        self.blocks = [(blk['lo'], blk['hi']) for blk in manifest['blocks']]
+        self.nnzPerBlock = [blk['nnz'] for blk in manifest['blocks']]
+
+    def __getattr__(self, name):
+        if(name=='nnz'):
+            return sum(self.nnzPerBlock)
+        elif(name=='nBlocks'):
+            return len(self.blocks)
+
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def __repr__(self):
+        return f"ShardedMDP({self.nStates} states, {self.nActions} actions, {self.nnz} transitions, {self.nBlocks} shards)"
+
+    # The arrays of shard 'i', memory-mapped read-only
+    def shard(self, i: int) -> dict[str, np.ndarray]:
+        return {name : np.load(_shard_path(self.directory, i, name), mmap_mode='r')
+                    for name in ('rows', 'probs', 'next_states', 'R', 'valid')}
+
+
+def _shard_path(directory, i, name) -> str:
+    return os.path.join(directory, f"shard-{i:05d}-{name}.npy")
+
+
+# Write the shards of a model with 'nStates' states and 'nActions' actions into 'directory' (made if needed), and open them
+# 'chunks' is an iterable of arrays (st, a, p, s, r) with one element per transition, as in MDP.from_arrays,
+#   ... of any size and in any order, so that a model bigger than memory can be streamed in from wherever it's made
+# The transitions are first appended to a temporary bucket file per block of 'blockStates' states,
+#   ... and then each bucket is sorted in memory on its own, so a block's transitions need to fit in memory
+# 'dtype' (float32 or float64) is the storage type of the probs and the expected rewards
+# 'state_action_pairs' is None to allow exactly the pairs that have transitions,
+#   ... or a bool array of shape (nStates, nActions), see CompiledMDP.valid
+# 'tol' : the probs of every pair must add up to 1 within 'tol' (set tol=None to skip this check)
+def write_shards(directory, nStates: int, nActions: int, chunks, blockStates=1_000_000, dtype=np.float32,
+                     state_action_pairs=None, tol=1e-6) -> ShardedMDP:
+    dtype = np.dtype(dtype)
+    if(dtype not in (np.float32, np.float64)):
+        raise ValueError(f"Unknown value for arg 'dtype': {dtype} in call to write_shards()")
+    if(blockStates * nActions >= 2**31):
+        raise ValueError(f"Expected less than 2**31 state-action pairs per shard, got blockStates={blockStates}")
+    valid = None if (state_action_pairs is None) else np.asarray(state_action_pairs, dtype=bool)
+    if(valid is not None and valid.shape != (nStates, nActions)):
+        raise ValueError(f"Expected state_action_pairs of shape {(nStates, nActions)}, got {valid.shape}")
+
+    os.makedirs(directory, exist_ok=True)
+    blocks = [(lo, min(lo + blockStates, nStates)) for lo in range(0, nStates, blockStates)]
+    buckets = [os.path.join(directory, f"bucket-{i:05d}.tmp") for i in range(len(blocks))]
+    for path in buckets:
+        open(path, "wb").close()
+
+    try:
+        for st, a, p, s, r in chunks:
+            st, a, p, s, r = check_transition_arrays(nStates, nActions, st, a, p, s, r)
+
+            blk = st // blockStates
+            order = np.argsort(blk, kind='stable')
+            bounds = np.searchsorted(blk[order], np.arange(len(blocks)+1))
+            for i in np.flatnonzero(np.diff(bounds)).tolist():
+                idx = order[bounds[i]:bounds[i+1]]
+                rec = np.empty(len(idx), dtype=_BUCKET_RECORD)
+                rec['k'], rec['p'], rec['s'], rec['r'] = st[idx]*nActions + a[idx], p[idx], s[idx], r[idx]
+                with open(buckets[i], "ab") as outfile:
+                    rec.tofile(outfile)
+
+        manifest = {'version_no'  :  SHARD_VERSION,
+                    'nStates'     :  nStates,
+                    'nActions'    :  nActions,
+                    'dtype'       :  dtype.str,
+                    'blocks'      :  []}
+        for i, (lo, hi) in enumerate(blocks):
+            nnz = _write_shard(directory, i, lo, hi, nStates, nActions, np.fromfile(buckets[i], dtype=_BUCKET_RECORD),
+                                   None if (valid is None) else valid[lo:hi], dtype, tol)
+            os.remove(buckets[i])
+            manifest['blocks'].append({'lo': lo, 'hi': hi, 'nnz': nnz})
+    finally:
+        for path in buckets:
+            if(os.path.exists(path)):
+                os.remove(path)
+
+    with open(os.path.join(directory, SHARD_MANIFEST), "w") as outfile:
+        json.dump(manifest, outfile)
+    return ShardedMDP(directory)
+
+
+# Sort the transitions of the states lo..hi-1 (of a model with 'nStates' states) and write them as shard 'i',
+#   ... returning its no. of transitions
+def _write_shard(directory, i, lo, hi, nStates, nActions, rec, valid, dtype, tol) -> int:
+    nPairs = (hi - lo) * nActions
+    order = np.argsort(rec['k'], kind='stable')
+    rows = rec['k'][order] - lo*nActions
+    probs, nextStates, rewards = rec['p'][order], rec['s'][order], rec['r'][order]
+    del rec, order
+
+    valid = check_pair_counts(rows, probs, valid, hi-lo, nActions, tol, lo=lo)[1]
+
+    R = np.bincount(rows, weights=probs*rewards, minlength=nPairs).reshape(hi-lo, nActions)
+    idx_type = np.int32 if (nStates < 2**31) else np.int64
+    arrays = {'rows'         :  rows.astype(np.int32),
+              'probs'        :  probs.astype(dtype),
+              'next_states'  :  nextStates.astype(idx_type),
+              'R'            :  R.astype(dtype),
+              'valid'        :  valid}
+    for name, arr in arrays.items():
+        np.save(_shard_path(directory, i, name), arr)
+    return len(rows)
+
+
+# Write the shards of an MDP, e.g. one memory-mapped by MDP.load() from a binary file, reading one block at a time
+def shard_mdp(mdp: MDP, directory, blockStates=1_000_000, dtype=np.float32) -> ShardedMDP:
+    c = mdp.compile()
+    def chunks():
+        for lo in range(0, c.nStates, blockStates):
+            hi = min(lo + blockStates, c.nStates)
+            k0, k1 = c.indptr[lo*c.nActions], c.indptr[hi*c.nActions]
+            k = np.repeat(np.arange(lo*c.nActions, hi*c.nActions), np.diff(c.indptr[lo*c.nActions : hi*c.nActions+1]))
+            yield k // c.nActions, k % c.nActions, c.probs[k0:k1], c.next_states[k0:k1], c.rewards[k0:k1]
+    return write_shards(directory, c.nStates, c.nActions, chunks(), blockStates=blockStates, dtype=dtype,
+                            state_action_pairs=c.valid, tol=None)
+
+
+
+# Value iteration over a ShardedMDP, streaming all its shards through every sweep
+# 'mode' picks how the sweeps are done:
+#       'gauss-seidel'  :  the states of each shard are backed up in place, reading the values that the shards before it
+#                          ... updated in the same sweep; this needs just one vector of state-values in memory
+#       'vectorized'    :  Jacobi sweeps on two vectors, which (with float64 storage) give the same values as
+#                          ... BellmanBackup.estimate_V_star's mode 'vectorized'
+# stops when a sweep changes no element by 10**(-thresh) or more
+# set thresh=None to not consider a threshold, running till 'maxIter' is exhausted
+# 'V' is an optional starting guess, and 'callback' is called after every sweep, see BellmanBackup's SOLVER INSTRUMENTATION
+# Returns (V, iterCnt), with V a float64 array
+def estimate_V_star_ooc(sharded: ShardedMDP, gamma, thresh=4, maxIter=10_000, mode='gauss-seidel', V=None, callback=None):
+    if(mode not in ('gauss-seidel', 'vectorized')):
+        raise ValueError(f"Unknown value for arg 'mode': {mode} in call to estimate_V_star_ooc()")
+    limit = (10**-thresh) if(thresh is not None) else 0.
+    report = _reporter(callback)
+    V = np.zeros(sharded.nStates) if (V is None) else np.array(V, dtype=np.float64)
+
+    iterCnt = 0
+    while(iterCnt < maxIter):
+        VV = V if (mode == 'gauss-seidel') else np.empty_like(V)
+        diff = 0.
+        for i, (lo, hi) in enumerate(sharded.blocks):
+            shard = sharded.shard(i)
+            newV = B_block_vec(shard['rows'], shard['probs'], shard['next_states'], shard['R'], shard['valid'], V, gamma)
+            diff = max(diff, np.abs(newV - V[lo:hi]).max(initial=0.))
+            VV[lo:hi] = newV
+        V = VV
+        iterCnt += 1
+        if((report and report(iterCnt, diff, iterCnt*sharded.nStates)) or diff < limit):
+            break
+
+    return V, iterCnt
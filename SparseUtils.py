@@ -0,0 +1,174 @@
+import numpy as np
+
+# Helpers for sparse matrices held as plain CSR arrays (indptr, indices, data)
+# Row 'i' has the entries data[indptr[i]:indptr[i+1]] in the columns indices[indptr[i]:indptr[i+1]]
+# Duplicate column entries in a row are allowed, and are summed up
+
+
+
+# The row-number of every stored entry, i.e. the indptr expanded to one entry per element of 'data'
+def csr_row_ids(indptr: np.ndarray) -> np.ndarray:
+    nRows = len(indptr) - 1
+    return np.repeat(np.arange(nRows, dtype=np.int64), np.diff(indptr))
+
+
+# The stored entries of the selected rows, as the CSR indptr of those rows alone, 
+#   ... and the positions of their entries in indices/data
+def csr_gather(indptr, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    starts = indptr[rows]
+    lengths = indptr[rows+1] - starts
+    ptr = np.zeros(len(rows)+1, dtype=np.int64)
+    np.cumsum(lengths, out=ptr[1:])
+    idx = np.arange(ptr[-1], dtype=np.int64) + np.repeat(starts - ptr[:-1], lengths)
+    return ptr, idx
+
+
+# The matrix-vector product A @ x
+# Pass 'rows' (from csr_row_ids) when calling this repeatedly on the same matrix
+def csr_matvec(indptr, indices, data, x, rows=None) -> np.ndarray:
+    if(rows is None):
+        rows = csr_row_ids(indptr)
+    return np.bincount(rows, weights=data*x[indices], minlength=len(indptr)-1)
+
+
+# The vector-matrix product x @ A, for a matrix with 'nCols' columns
+def csr_rmatvec(indptr, indices, data, x, nCols: int, rows=None) -> np.ndarray:
+    if(rows is None):
+        rows = csr_row_ids(indptr)
+    return np.bincount(indices, weights=data*x[rows], minlength=nCols)
+
+
+# The same matrix with the entries of each row sorted by column, and duplicate entries summed up
+def csr_sum_duplicates(indptr, indices, data, nCols: int):
+    nRows = len(indptr) - 1
+    keys = csr_row_ids(indptr)*nCols + indices
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    ptr = np.zeros(nRows+1, dtype=np.int64)
+    np.cumsum(np.bincount(uniq // nCols, minlength=nRows), out=ptr[1:])
+    return ptr, uniq % nCols, np.bincount(inverse, weights=data, minlength=len(uniq))
+
+
+# The sub-matrix A[members][:,members] of the rows and columns in 'members' (an array of row-numbers)
+# Returns its CSR arrays, with the rows and columns renumbered by their position in 'members'
+def csr_submatrix(indptr, indices, data, members: np.ndarray):
+    n = len(indptr) - 1
+    local = np.full(n, -1, dtype=np.int64)
+    local[members] = np.arange(len(members))
+    ptr, idx = csr_gather(indptr, members)
+    cols = local[indices[idx]]
+    keep = cols >= 0
+    rowIds = csr_row_ids(ptr)[keep]
+    sub_indptr = np.zeros(len(members)+1, dtype=np.int64)
+    np.cumsum(np.bincount(rowIds, minlength=len(members)), out=sub_indptr[1:])
+    return sub_indptr, cols[keep], data[idx][keep]
+
+
+# The strongly connected components of the directed graph with an edge i -> j for every stored entry (i,j)
+# Uses an iterative version of Tarjan's algorithm
+# Returns (nComps, labels) with labels[i] the component of node 'i'
+# Components are numbered in reverse topological order: every edge i -> j has labels[i] >= labels[j]
+def strongly_connected_components(indptr, indices) -> tuple[int, np.ndarray]:
+    n = len(indptr) - 1
+    ptr, adj = indptr.tolist(), indices.tolist()
+    index, low = [-1]*n, [0]*n
+    onStack = [False]*n
+    stack = []
+    labels = [-1]*n
+    nComps, counter = 0, 0
+    
+    for root in range(n):
+        if(index[root] != -1):
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        onStack[root] = True
+        work = [[root, ptr[root]]]          # the DFS path, as (node, position in its adjacency list)
+        
+        while(work):
+            frame = work[-1]
+            v, i = frame
+            if(i < ptr[v+1]):
+                frame[1] += 1
+                w = adj[i]
+                if(index[w] == -1):
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    onStack[w] = True
+                    work.append([w, ptr[w]])
+                elif(onStack[w] and index[w] < low[v]):
+                    low[v] = index[w]
+            else:
+                work.pop()
+                if(work and low[v] < low[work[-1][0]]):
+                    low[work[-1][0]] = low[v]
+                if(low[v] == index[v]):         # 'v' is the root of a component, pop it off the stack
+                    while(True):
+                        w = stack.pop()
+                        onStack[w] = False
+                        labels[w] = nComps
+                        if(w == v):
+                            break
+                    nComps += 1
+    
+    return nComps, np.array(labels, dtype=np.int64)
+
+
+# Solve the linear system A @ x = b with restarted GMRES, where 'matvec(v)' returns A @ v
+# Stops once ||b - A @ x||_2 <= atol, or after 'maxIter' calls to matvec
+# 'callback(nIter, resNorm)', if given, is called after every call to matvec with the current residual norm,
+#   ... and stops the solve if it returns True
+# Returns (x, nIter), nIter being the number of calls to matvec
+def gmres(matvec, b, x0=None, atol=1e-10, restart=30, maxIter=10_000, callback=None) -> tuple[np.ndarray, int]:
+    n = len(b)
+    x = np.zeros(n) if (x0 is None) else np.array(x0, dtype=np.float64)
+    atol = max(atol, np.finfo(np.float64).eps * np.linalg.norm(b))
+    nIter = 0
+    stop = False
+    
+    while(nIter < maxIter and not stop):
+        r = b - matvec(x)
+        beta = np.linalg.norm(r)
+        if(beta <= atol):
+            break
+        
+        m = min(restart, maxIter - nIter)
+        basis = np.empty((m+1, n))
+        H = np.zeros((m+1, m))
+        cs, sn = np.zeros(m), np.zeros(m)
+        g = np.zeros(m+1)
+        basis[0] = r / beta
+        g[0] = beta
+        
+        k = 0
+        while(k < m):
+            w = matvec(basis[k])
+            nIter += 1
+            # modified Gram-Schmidt against the basis so far
+            for i in range(k+1):
+                H[i,k] = w @ basis[i]
+                w -= H[i,k] * basis[i]
+            H[k+1,k] = np.linalg.norm(w)
+            if(H[k+1,k] > 0):
+                basis[k+1] = w / H[k+1,k]
+            # rotate the new column of H into upper-triangular form
+            for i in range(k):
+                H[i,k], H[i+1,k] = cs[i]*H[i,k] + sn[i]*H[i+1,k], -sn[i]*H[i,k] + cs[i]*H[i+1,k]
+            denom = np.hypot(H[k,k], H[k+1,k])
+            if(denom == 0):
+                break
+            cs[k], sn[k] = H[k,k]/denom, H[k+1,k]/denom
+            H[k,k], H[k+1,k] = denom, 0.
+            g[k], g[k+1] = cs[k]*g[k], -sn[k]*g[k]
+            k += 1
+            stop = (callback is not None) and bool(callback(nIter, abs(g[k])))
+            if(stop or abs(g[k]) <= atol):
+                break
+        
+        if(k == 0):             # A is singular along the residual, no progress possible
+            break
+        y = np.linalg.solve(np.triu(H[:k,:k]), g[:k])
+        x += basis[:k].T @ y
+        
+    return x, nIter
@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from MDP import MDP, BINARY_EXTENSION
+from MarkovChain import estimate_steady_dist
+from MDP_Iterators import Policy_MDP_Iterator, simulate_batch
+import BellmanBackup as bb
+
+# Benchmarks of the solvers, samplers and file formats, on random MDPs of growing size
+# Run it as a script, e.g.
+#       python benchmark_mdp.py --sizes 1000 10000 100000 --out new.json --compare old.json
+# Each result reports the best time over some repeats, a throughput (e.g. backups/s), and the peak memory of one run
+# The json output of two runs on the same settings can be compared with compare_results()
+
+
+
+########################
+#  RANDOM MDPs
+########################
+
+
+# A random 'Garnet' MDP: every state-action pair has 'branching' transitions, to next-states drawn uniformly at random
+#   ... with probs from a random partition of [0,1]
+# 'reward' is the distribution of the rewards (one per transition):
+#       'uniform'  :  uniform in [0,1)
+#       'normal'   :  standard normal
+#       or a callable  reward(rng, size) -> array
+# 'actions_per_state' is the no. of possible actions in each state (a random subset), default all 'nActions'
+def garnet_mdp(nStates, nActions, branching=5, reward='uniform', seed=None, actions_per_state=None) -> MDP:
+    rng = np.random.default_rng(seed)
+
+    if(actions_per_state is None or actions_per_state >= nActions):
+        valid = np.ones((nStates, nActions), dtype=bool)
+    else:
+        valid = np.zeros((nStates, nActions), dtype=bool)
+        choice = np.argsort(rng.random((nStates, nActions)), axis=1)[:, :actions_per_state]
+        valid[np.arange(nStates)[:,None], choice] = True
+
+    k = np.flatnonzero(valid)
+    st = np.repeat(k // nActions, branching)
+    a = np.repeat(k % nActions, branching)
+
+    cuts = np.sort(rng.random((len(k), branching-1)), axis=1)
+    probs = np.diff(cuts, axis=1, prepend=0., append=1.).ravel()
+    nextStates = rng.integers(0, nStates, size=len(st))
+
+    if(reward == 'uniform'):
+        rewards = rng.random(len(st))
+    elif(reward == 'normal'):
+        rewards = rng.standard_normal(len(st))
+    elif(callable(reward)):
+        rewards = np.asarray(reward(rng, len(st)), dtype=np.float64)
+    else:
+        raise ValueError(f"Unknown value for arg 'reward': {reward} in call to garnet_mdp()")
+
+    return MDP.from_arrays(nStates, nActions, st, a, probs, nextStates, rewards, state_action_pairs=valid, tol=1e-9)
+
+
+# A random locally connected MDP: a corridor of states, where every action moves about 'drift' states along it,
+#   ... with 'branching' transitions to the states around that (clipped to the ends), with random probs
+# The drifts of the actions are spread evenly over [-1, 1], so with 2 actions one moves left and the other right
+# Only the transitions into the last state get a reward (of 1), so the values spread back from that end,
+#   ... which suits the solvers that follow the changes rather than sweeping everything, e.g. mode 'prioritized'
+def corridor_mdp(nStates, nActions=2, branching=5, seed=None) -> MDP:
+    rng = np.random.default_rng(seed)
+    offsets = np.arange(branching) - branching//2
+    drifts = np.linspace(-1., 1., nActions) if (nActions > 1) else np.ones(1)
+
+    st = np.repeat(np.arange(nStates), nActions*branching)
+    a = np.tile(np.repeat(np.arange(nActions), branching), nStates)
+    off = np.tile(offsets, nStates*nActions)
+    w = np.exp(-(off - np.round(drifts[a]))**2) * rng.uniform(0.5, 1.5, size=len(st))
+    probs = (w.reshape(-1, branching) / w.reshape(-1, branching).sum(axis=1, keepdims=True)).ravel()
+    nextStates = np.clip(st + off, 0, nStates-1)
+    rewards = (nextStates == nStates-1).astype(np.float64)
+
+    return MDP.from_arrays(nStates, nActions, st, a, probs, nextStates, rewards, state_action_pairs='all', tol=1e-9)
+
+
+# The generators of run_suite(), by name
+MODELS = {
+    'garnet'    :  lambda nStates, nActions, branching, reward, seed: \
+                       garnet_mdp(nStates, nActions, branching=branching, reward=reward, seed=seed),
+    'corridor'  :  lambda nStates, nActions, branching, reward, seed: \
+                       corridor_mdp(nStates, nActions, branching=branching, seed=seed),
+}
+
+
+# A random policy over the possible actions of 'mdp', as an int array
+def random_policy(mdp: MDP, seed=None) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    valid = mdp.compile().valid
+    nValid = valid.sum(axis=1)
+    j = (rng.random(mdp.nStates) * nValid).astype(np.int64)
+    return np.argmax(np.cumsum(valid, axis=1) > j[:,None], axis=1)
+
+
+
+########################
+#  BENCHMARKS
+########################
+# Each benchmark takes (mdp, gamma, policy, options) and returns (work, unit), the amount of work that it did
+# The compiled model is built before timing, except where building things is what's being measured
+
+
+def _bench_B_vec(mdp, gamma, policy, opts):
+    bb.B_vec(mdp, np.zeros(mdp.nStates), gamma)
+    return mdp.nStates, "backups"
+
+def _bench_B(mdp, gamma, policy, opts):
+    bb.B(mdp, [0.] * mdp.nStates, gamma)
+    return mdp.nStates, "backups"
+
+def _bench_Bpi(mdp, gamma, policy, opts):
+    bb.Bpi(mdp, [0.] * mdp.nStates, bb.policy_to_dict(policy), gamma)
+    return mdp.nStates, "backups"
+
+def _bench_Bpi_vec(mdp, gamma, policy, opts):
+    bb.Bpi_vec(mdp, np.zeros(mdp.nStates), policy, gamma)
+    return mdp.nStates, "backups"
+
+def _bench_pi_greedy(mdp, gamma, policy, opts):
+    bb.pi_greedy(mdp, [0.] * mdp.nStates, gamma)
+    return mdp.nStates, "states"
+
+def _bench_pi_greedy_vec(mdp, gamma, policy, opts):
+    bb.pi_greedy_vec(mdp, np.zeros(mdp.nStates), gamma)
+    return mdp.nStates, "states"
+
+def _bench_estimate_V_star(mdp, gamma, policy, opts):
+    V, iterCnt = bb.estimate_V_star(mdp, gamma, thresh=opts['thresh'], mode=opts['mode'])
+    return iterCnt * mdp.nStates, "backups"
+
+def _bench_estimate_V_pi(mdp, gamma, policy, opts):
+    bb.estimate_V_pi(mdp, policy, gamma, thresh=opts['thresh'])
+    return mdp.nStates, "states"
+
+def _bench_getMarkovChain(mdp, gamma, policy, opts):
+    mdp.getMarkovChain(policy, sparse=True)
+    return mdp.nStates, "states"
+
+def _bench_save_load_json(mdp, gamma, policy, opts):
+    return _save_load(mdp, "mdp.json")
+
+def _bench_save_load_binary(mdp, gamma, policy, opts):
+    return _save_load(mdp, "mdp" + BINARY_EXTENSION)
+
+def _save_load(mdp, name):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, name)
+        mdp.save(path)
+        loaded = MDP.load(path)
+        loaded.compile()
+    return mdp.compile().nnz, "transitions"
+
+def _bench_estimate_steady_dist(mdp, gamma, policy, opts):
+    chain = mdp.getMarkovChain(policy, sparse=True)
+    estimate_steady_dist(chain, start=0, nIter=opts['steps'], rng=0)
+    return opts['steps'], "steps"
+
+def _bench_iterator_step(mdp, gamma, policy, opts):
+    it = Policy_MDP_Iterator(bb.policy_to_dict(policy), mdp, start=0, gamma=gamma, rng=0, maxIter=opts['steps'])
+    for s,r in it:
+        pass
+    return opts['steps'], "steps"
+
+def _bench_simulate_batch(mdp, gamma, policy, opts):
+    n, horizon = 1_000, max(1, opts['steps'] // 1_000)
+    simulate_batch(mdp, policy, n_episodes=n, horizon=horizon, gamma=gamma, seed=0, start=0)
+    return n * horizon, "steps"
+
+
+BENCHMARKS = {
+    'B_vec'                 :  _bench_B_vec,
+    'B'                     :  _bench_B,
+    'Bpi'                   :  _bench_Bpi,
+    'Bpi_vec'               :  _bench_Bpi_vec,
+    'pi_greedy'             :  _bench_pi_greedy,
+    'pi_greedy_vec'         :  _bench_pi_greedy_vec,
+    'estimate_V_star'       :  _bench_estimate_V_star,
+    'estimate_V_pi'         :  _bench_estimate_V_pi,
+    'getMarkovChain'        :  _bench_getMarkovChain,
+    'save_load_json'        :  _bench_save_load_json,
+    'save_load_binary'      :  _bench_save_load_binary,
+    'estimate_steady_dist'  :  _bench_estimate_steady_dist,
+    'iterator_step'         :  _bench_iterator_step,
+    'simulate_batch'        :  _bench_simulate_batch,
+}
+
+# The benchmarks that work on the dict-based model, and are only run upto 'python_max_states' states
+PYTHON_BENCHMARKS = {'B', 'Bpi', 'pi_greedy', 'save_load_json'}
+
+
+# Run one benchmark: the best time over 'repeat' runs, then one more run under tracemalloc for the peak memory
+# mdp.policyCache is cleared before every run, so that repeated runs time the work and not cache hits
+def run_benchmark(name, mdp, gamma, policy, opts, repeat=3) -> dict:
+    fn = BENCHMARKS[name]
+    best = np.inf
+    for i in range(repeat):
+        mdp.policyCache.clear()
+        t0 = time.perf_counter()
+        work, unit = fn(mdp, gamma, policy, opts)
+        best = min(best, time.perf_counter() - t0)
+
+    mdp.policyCache.clear()
+    tracemalloc.start()
+    try:
+        fn(mdp, gamma, policy, opts)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'benchmark'   :  name,
+            'seconds'     :  best,
+            'work'        :  work,
+            'unit'        :  unit,
+            'throughput'  :  work / best if (best > 0) else float('inf'),
+            'peak_mb'     :  peak / 2**20}
+
+
+# Run the benchmarks on random MDPs of each size in 'sizes', made by the generator named by 'model' (see MODELS)
+# Returns a json-serializable dict {'meta': {...}, 'results': [...]}, with one result per (benchmark, size)
+def run_suite(sizes, nActions=4, branching=5, gamma=0.95, reward='uniform', seed=0, benchmarks=None,
+                  model='garnet', repeat=3, thresh=4, mode='vectorized', steps=100_000, python_max_states=10_000, verbose=True) -> dict:
+    benchmarks = list(BENCHMARKS) if (benchmarks is None) else list(benchmarks)
+    opts = {'thresh': thresh, 'mode': mode, 'steps': steps}
+    results = []
+    for nStates in sizes:
+        mdp = MODELS[model](nStates, nActions, branching, reward, seed)
+        mdp.compile()
+        policy = random_policy(mdp, seed=seed)
+        for name in benchmarks:
+            if(name in PYTHON_BENCHMARKS and nStates > python_max_states):
+                continue
+            res = run_benchmark(name, mdp, gamma, policy, opts, repeat=repeat)
+            res.update({'nStates': nStates, 'nActions': nActions, 'branching': branching})
+            results.append(res)
+            if(verbose):
+                print(f"{name:>22s}  nStates={nStates:<9d} {res['seconds']:10.4f}s  "
+                      f"{res['throughput']:14.1f} {res['unit']}/s  peak {res['peak_mb']:9.1f} MB")
+
+    meta = {'python'     :  platform.python_version(),
+            'numpy'      :  np.__version__,
+            'machine'    :  platform.machine(),
+            'processor'  :  platform.processor(),
+            'time'       :  time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'settings'   :  {'model': model, 'sizes': list(sizes), 'nActions': nActions, 'branching': branching, 'gamma': gamma,
+                             'reward': reward, 'seed': seed, 'repeat': repeat, 'thresh': thresh, 'mode': mode,
+                             'steps': steps}}
+    return {'meta': meta, 'results': results}
+
+
+# Compare two outputs of run_suite(), matching results on (benchmark, nStates, nActions, branching)
+# Returns a list of (benchmark, nStates, old seconds, new seconds, speedup = old/new)
+def compare_results(old: dict, new: dict) -> list[tuple]:
+    key = lambda res: (res['benchmark'], res['nStates'], res['nActions'], res['branching'])
+    before = {key(res): res for res in old['results']}
+    rows = []
+    for res in new['results']:
+        if(key(res) in before):
+            t0, t1 = before[key(res)]['seconds'], res['seconds']
+            rows.append((res['benchmark'], res['nStates'], t0, t1, t0/t1 if (t1 > 0) else float('inf')))
+    return rows
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the MDP solvers on random (Garnet) MDPs")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--model", default="garnet", choices=list(MODELS))
+    parser.add_argument("--actions", type=int, default=4)
+    parser.add_argument("--branching", type=int, default=5)
+    parser.add_argument("--gamma", type=float, default=0.95)
+    parser.add_argument("--reward", default="uniform", choices=["uniform", "normal"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--thresh", type=int, default=4)
+    parser.add_argument("--mode", default="vectorized", help="the mode of estimate_V_star")
+    parser.add_argument("--steps", type=int, default=100_000, help="steps for the sampling benchmarks")
+    parser.add_argument("--python-max-states", type=int, default=10_000)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--out", help="write the results to this json file")
+    parser.add_argument("--compare", help="a json file from an earlier run, to compare against")
+    args = parser.parse_args()
+
+    report = run_suite(args.sizes, nActions=args.actions, branching=args.branching, gamma=args.gamma,
+                       reward=args.reward, seed=args.seed, benchmarks=args.only, model=args.model, repeat=args.repeat,
+                       thresh=args.thresh, mode=args.mode, steps=args.steps, python_max_states=args.python_max_states)
+    if(args.out):
+        with open(args.out, "w") as outfile:
+            json.dump(report, outfile, indent=1)
+    if(args.compare):
+        with open(args.compare, "r") as infile:
+            old = json.load(infile)
+        print("\nspeedup vs", args.compare)
+        for name, nStates, t0, t1, speedup in compare_results(old, report):
+            print(f"{name:>22s}  nStates={nStates:<9d} {t0:10.4f}s -> {t1:10.4f}s   x{speedup:.2f}")